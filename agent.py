@@ -0,0 +1,139 @@
+"""
+Attach agent: lets the plugin debug a process that is already running,
+instead of one started by debugger.py. The process imports it and
+installs it once, at startup:
+
+    import agent
+    agent.install()                       # listen on 127.0.0.1:5679
+    agent.install(signum=signal.SIGUSR1)  # listen from the first SIGUSR1
+
+Nothing is traced until the plugin attaches with "Attach to Process", and
+with a signal there isn't even a socket until the signal arrives. The
+plugin hands over its breakpoints when it attaches. Stopping the session
+detaches: the breakpoints go, every tracer is removed and the process runs
+at full speed again, ready for the next attach.
+
+Python 3.12+ traces every thread. Before that only threads started after
+the attach are traced, plus the main thread if the agent was installed
+with a signal, which it then sends itself.
+"""
+import os
+import signal
+import socket
+import threading
+
+import debugger
+
+# where the agent listens, [host:]port. the environment overrides the
+# default
+AGENT_ADDRESS_ENV = 'PYTHON_DEBUGGER_AGENT'
+DEFAULT_ADDRESS = '127.0.0.1:5679'
+
+class Connection(debugger.CommandQueue):
+    """
+    One attached plugin. Its commands are read on the agent's thread, a
+    stopped thread of the process takes them with readline(). The end of
+    the connection wakes that thread up
+    """
+    def __init__(self, sock):
+        debugger.CommandQueue.__init__(self)
+        self.sock = sock
+
+    def run(self):
+        self.read_lines(self.sock)
+        self.ended()
+
+    # a plugin that went away misses the rest
+    def sendall(self, data):
+        try:
+            self.sock.sendall(data)
+        except socket.error:
+            pass
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+class Agent(object):
+    """
+    Waits for the plugin on address, one at a time. Every attach gets a
+    debugger of its own, which is detached when the plugin leaves
+    """
+    def __init__(self, address, signum=None):
+        self.address = debugger.parse_address(address)
+        self.signum = signum
+        self.lock = threading.Lock()
+        self.server = None
+        self.debugger = None
+
+    # the trigger, from here on the plugin can attach
+    def listen(self):
+        with self.lock:
+            if self.server is not None:
+                return
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server.bind(self.address)
+            self.server.listen(1)
+            self.address = self.server.getsockname()
+        debugger.start_thread(self.serve)
+
+    def serve(self):
+        while True:
+            sock = self.server.accept()[0]
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.session(sock)
+
+    def session(self, sock):
+        conn = Connection(sock)
+        # the process keeps its own output
+        channel = debugger.Channel(conn)
+        dbg = debugger.create_debugger(conn, channel.writer, os.environ.get('PYTHON_DEBUGGER_ENGINE'))
+        dbg.channel = channel
+        dbg.own_files.add(dbg.canonic(__file__.replace('.pyc', '.py')))
+        # breakpoints change while the process runs, not at its next stop
+        conn.urgent['attach'] = lambda data: self.attach(dbg, data)
+        conn.urgent['addbreakpoint'] = dbg.do_addbreakpoint
+        conn.urgent['removebreakpoint'] = dbg.do_removebreakpoint
+        conn.urgent['quit'] = lambda data: conn.close()
+        channel.writer.send('ready', {})
+        try:
+            conn.run()
+        finally:
+            with self.lock:
+                self.debugger = None
+            dbg.detach()
+            channel.close()
+            sock.close()
+
+    def attach(self, dbg, data):
+        dbg.do_attach(data)
+        with self.lock:
+            self.debugger = dbg
+        # before python 3.12 a running thread can only trace itself
+        if self.signum is not None and not hasattr(threading, 'settrace_all_threads'):
+            os.kill(os.getpid(), self.signum)
+
+    # runs on the main thread, frame is where it was interrupted
+    def on_signal(self, signum, frame):
+        self.listen()
+        with self.lock:
+            dbg = self.debugger
+        if dbg is not None and hasattr(dbg, 'trace_running'):
+            dbg.trace_running(frame)
+
+_agent = None
+
+# address is [host:]port. with signum the agent only listens once the
+# process gets that signal
+def install(address=None, signum=None):
+    global _agent
+    if _agent is None:
+        _agent = Agent(address or os.environ.get(AGENT_ADDRESS_ENV, DEFAULT_ADDRESS), signum)
+        if signum is None:
+            _agent.listen()
+        else:
+            signal.signal(signum, _agent.on_signal)
+    return _agent
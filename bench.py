@@ -0,0 +1,735 @@
+"""
+Benchmarks for the debugger, run outside Sublime Text:
+
+    python bench.py [--python PYTHON] [--engine ENGINE] [--quick]
+                    [--output FILE] [--compare OLD_FILE]
+
+debugger.py is driven over pipes the way the plugin runs it, with
+generated scripts: a tight loop of calls, deep recursion, a file full of
+breakpoints and heavy printing. It measures how much slower a script runs
+while continuing, how long a step takes from 'next' to 'break', the round
+trip of a request answered while stopped, and how fast output gets
+through. Each engine the target python has is measured.
+plugin.py's handling of output, stops and variables is timed in this
+interpreter, against a stub sublime module. The results are written as
+json, and --compare prints how each number moved against an earlier run.
+"""
+import os
+import sys
+import json
+import time
+import types
+import bisect
+import select
+import shutil
+import platform
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+from jsoncmd import MessageFramer, FRAME_OUTPUT
+
+DEBUGGER = os.path.join(HERE, 'debugger.py')
+
+# seconds a debugger gets to answer before the benchmark gives up on it
+TIMEOUT = 120
+
+# workload sizes, full and --quick
+SIZES = {
+    'calls' : (1000000, 100000),
+    'iterations' : (200000, 20000),
+    'depth' : (500, 500),
+    'recursions' : (400, 40),
+    'cold_functions' : (200, 200),
+    'lines' : (100000, 10000),
+    'steps' : (200, 30),
+    'renders' : (200, 30),
+    'output_messages' : (2000, 200),
+}
+
+#-----------------------------------------------------------------------------
+# Target scripts. each one times its own workload and prints it last
+
+LOOP_SCRIPT = '''
+import time
+def step(i):
+    return i % 7
+def work(n):
+    total = 0
+    for i in range(n):
+        total += step(i)
+    return total
+start = time.time()
+work({calls})
+print('elapsed %r' % (time.time() - start))
+'''
+
+RECURSION_SCRIPT = '''
+import sys, time
+sys.setrecursionlimit(10000)
+def deep(n):
+    if n == 0:
+        return 0
+    return deep(n - 1) + 1
+start = time.time()
+for _ in range({recursions}):
+    deep({depth})
+print('elapsed %r' % (time.time() - start))
+'''
+
+# the breakpoints are in functions that never run, plus one in the hot loop
+# whose condition never holds
+BREAKPOINTS_SCRIPT = '''
+import time
+def work(n):
+    total = 0
+    for i in range(n):
+        total += i % 7
+    return total
+{cold}
+start = time.time()
+work({iterations})
+print('elapsed %r' % (time.time() - start))
+'''
+BREAKPOINTS_HOT_LINE = 6
+
+COLD_FUNCTION = '''
+def cold{0}(x):
+    y = x + 1
+    return y
+'''
+
+PRINT_SCRIPT = '''
+import time
+line = 'x' * 79
+start = time.time()
+for i in range({lines}):
+    print(line)
+print('elapsed %r' % (time.time() - start))
+'''
+
+# stepped through from the breakpoint on the loop line
+STEP_SCRIPT = '''
+def work(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+work({steps})
+'''
+STEP_LINE = 4
+
+def write_script(directory, name, source):
+    path = os.path.join(directory, name + '.py')
+    with open(path, 'w') as f:
+        f.write(source)
+    return path
+
+def elapsed_from(text):
+    for line in reversed(text.splitlines()):
+        if line.startswith('elapsed '):
+            return float(line.split()[1])
+    raise RuntimeError('no elapsed time in output: {0!r}'.format(text[-200:]))
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    def at(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+    return {
+        'count' : len(ordered),
+        'p50_ms' : at(0.5) * 1000,
+        'p90_ms' : at(0.9) * 1000,
+        'max_ms' : ordered[-1] * 1000,
+    }
+
+#-----------------------------------------------------------------------------
+# debugger.py over pipes
+
+class DebuggerProcess(object):
+    """
+    debugger.py as the plugin runs it. Output is counted and only its tail
+    kept, every other message is handed back by wait_for()
+    """
+    def __init__(self, python, engine):
+        env = dict(os.environ)
+        env['PYTHON_DEBUGGER_ENGINE'] = engine
+        env['PYTHON_DEBUGGER_FRAMING'] = 'lines'
+        self.proc = subprocess.Popen([python, '-u', DEBUGGER],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        self.framer = MessageFramer()
+        self.messages = []
+        self.output_bytes = 0
+        self.output_tail = ''
+
+    def send(self, cmd, data):
+        self.proc.stdin.write((json.dumps({'command' : cmd, 'data' : data}) + '\n').encode('utf-8'))
+        self.proc.stdin.flush()
+
+    def read(self):
+        fd = self.proc.stdout.fileno()
+        if not select.select([fd], [], [], TIMEOUT)[0]:
+            raise RuntimeError('the debugger stopped answering')
+        data = os.read(fd, 2**16)
+        if not data:
+            raise RuntimeError('the debugger exited')
+        for kind, payload in self.framer.feed(data):
+            if kind == FRAME_OUTPUT:
+                self.add_output(payload.decode('utf-8', 'replace'))
+                continue
+            message = json.loads(payload.decode('utf-8'))
+            if message['command'] == 'output':
+                self.add_output(message['data'])
+            else:
+                self.messages.append((message['command'], message['data']))
+
+    def add_output(self, text):
+        self.output_bytes += len(text)
+        self.output_tail = (self.output_tail + text)[-1000:]
+
+    def wait_for(self, cmd):
+        while True:
+            while self.messages:
+                message = self.messages.pop(0)
+                if message[0] == cmd:
+                    return message[1]
+            self.read()
+
+    def start(self, target, breakpoints=None):
+        self.send('start', {
+            'target' : [target],
+            'breakpoints' : breakpoints or {},
+            'children' : False,
+        })
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+
+def run_plain(python, script):
+    start = time.time()
+    proc = subprocess.Popen([python, '-u', script], stdout=subprocess.PIPE)
+    output = proc.communicate()[0]
+    return output.decode('utf-8'), time.time() - start
+
+# the finished debugger, which kept the script's output, and the seconds
+# from start to exit
+def run_debugged(python, engine, script, breakpoints=None):
+    debugger = DebuggerProcess(python, engine)
+    try:
+        start = time.time()
+        debugger.start(script, breakpoints)
+        debugger.wait_for('exited')
+        wall = time.time() - start
+        return debugger, wall
+    finally:
+        debugger.close()
+
+def bench_continue(python, engine, script, repeat, breakpoints=None):
+    plain = min(elapsed_from(run_plain(python, script)[0]) for _ in range(repeat))
+    debugged = min(elapsed_from(run_debugged(python, engine, script, breakpoints)[0].output_tail)
+        for _ in range(repeat))
+    return {
+        'plain_s' : plain,
+        'debug_s' : debugged,
+        'slowdown' : debugged / plain,
+    }
+
+def bench_step(python, engine, script, steps):
+    debugger = DebuggerProcess(python, engine)
+    try:
+        debugger.start(script, {script : [STEP_LINE]})
+        stop = debugger.wait_for('break')
+        # a function's locals are a proxy on python 3.13, check they list
+        debugger.send('variables', {'stop_id' : stop['stop_id'], 'ref' : 'locals'})
+        if not debugger.wait_for('variables')['children']:
+            raise RuntimeError('no locals at the stop in work()')
+        samples = []
+        for _ in range(steps):
+            start = time.time()
+            debugger.send('next', {})
+            debugger.wait_for('break')
+            samples.append(time.time() - start)
+        return percentiles(samples)
+    finally:
+        debugger.close()
+
+# a request answered right away while stopped, so only the protocol and
+# the debugger's handling are timed, none of the script
+def bench_round_trip(python, engine, script, count):
+    debugger = DebuggerProcess(python, engine)
+    try:
+        debugger.start(script, {script : [STEP_LINE]})
+        debugger.wait_for('break')
+        samples = []
+        for _ in range(count):
+            start = time.time()
+            debugger.send('threads', {})
+            debugger.wait_for('threads')
+            samples.append(time.time() - start)
+        return percentiles(samples)
+    finally:
+        debugger.close()
+
+# the whole run, startup included, so the plain run pays it too
+def bench_output(python, engine, script, repeat):
+    plain_bytes, plain_s = 0, None
+    for _ in range(repeat):
+        output, seconds = run_plain(python, script)
+        plain_bytes = len(output)
+        plain_s = seconds if plain_s is None else min(plain_s, seconds)
+    debug_bytes, debug_s = 0, None
+    for _ in range(repeat):
+        debugger, seconds = run_debugged(python, engine, script)
+        debug_bytes = debugger.output_bytes
+        debug_s = seconds if debug_s is None else min(debug_s, seconds)
+    return {
+        'bytes' : debug_bytes,
+        'plain_mb_s' : plain_bytes / plain_s / 1e6,
+        'debug_mb_s' : debug_bytes / debug_s / 1e6,
+    }
+
+def target_info(python):
+    script = 'import sys; print(sys.version.split()[0]); print(hasattr(sys, "monitoring"))'
+    lines = subprocess.check_output([python, '-c', script]).decode('utf-8').split()
+    engines = ['bdb', 'monitoring'] if lines[1] == 'True' else ['bdb']
+    return lines[0], engines
+
+def bench_debugger(python, engines, quick, directory):
+    size = dict((name, sizes[1 if quick else 0]) for name, sizes in SIZES.items())
+    repeat = 1 if quick else 3
+
+    loop = write_script(directory, 'loop', LOOP_SCRIPT.format(**size))
+    recursion = write_script(directory, 'recursion', RECURSION_SCRIPT.format(**size))
+    cold = ''.join(COLD_FUNCTION.format(i) for i in range(size['cold_functions']))
+    many = write_script(directory, 'breakpoints', BREAKPOINTS_SCRIPT.format(cold=cold, **size))
+    printing = write_script(directory, 'printing', PRINT_SCRIPT.format(**size))
+    stepping = write_script(directory, 'stepping', STEP_SCRIPT.format(steps=size['steps'] * 2))
+
+    # a breakpoint on the first line of every cold function's body
+    first_cold = BREAKPOINTS_SCRIPT.split('\n').index('{cold}') + 3
+    breakpoints = [first_cold + 4 * i for i in range(size['cold_functions'])]
+    breakpoints.append({'line_number' : BREAKPOINTS_HOT_LINE, 'condition' : 'i < 0'})
+
+    results = {}
+    for engine in engines:
+        sys.stderr.write('debugger, {0} engine\n'.format(engine))
+        results[engine] = {
+            'continue_loop' : bench_continue(python, engine, loop, repeat),
+            'continue_recursion' : bench_continue(python, engine, recursion, repeat),
+            'continue_breakpoints' : bench_continue(python, engine, many, repeat, {many : breakpoints}),
+            'step' : bench_step(python, engine, stepping, size['steps']),
+            'round_trip' : bench_round_trip(python, engine, stepping, size['steps']),
+            'output' : bench_output(python, engine, printing, repeat),
+        }
+    return results
+
+#-----------------------------------------------------------------------------
+# A stub sublime module, enough of it for plugin.py's panes. Views hold
+# their text, and the plugin's own text commands edit it
+
+class Region(object):
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return self.end() - self.begin()
+
+    def intersects(self, other):
+        return self.begin() < other.end() and other.begin() < self.end()
+
+class Selection(list):
+    def clear(self):
+        del self[:]
+
+    def add(self, region):
+        self.append(region)
+
+class Settings(dict):
+    def get(self, key, default=None):
+        return dict.get(self, key, default)
+
+    def set(self, key, value):
+        self[key] = value
+
+    def erase(self, key):
+        self.pop(key, None)
+
+class View(object):
+    next_id = 1
+
+    def __init__(self, window, filename=None):
+        self._id = View.next_id
+        View.next_id += 1
+        self._window = window
+        self._filename = filename
+        self._settings = Settings()
+        self._sel = Selection([Region(0)])
+        self._regions = {}
+        self._starts = None
+        self._changes = 0
+        self._name = ''
+        self._viewport = (0, 0)
+        self.text = ''
+        if filename is not None and os.path.exists(filename):
+            with open(filename) as f:
+                self.text = f.read()
+
+    def id(self):
+        return self._id
+
+    def window(self):
+        return self._window
+
+    def file_name(self):
+        return self._filename
+
+    def name(self):
+        return self._name
+
+    def set_name(self, name):
+        self._name = name
+
+    def settings(self):
+        return self._settings
+
+    def set_scratch(self, scratch):
+        pass
+
+    def set_read_only(self, read_only):
+        pass
+
+    def scope_name(self, point):
+        return 'source.python '
+
+    def change_count(self):
+        return self._changes
+
+    def size(self):
+        return len(self.text)
+
+    def line_starts(self):
+        if self._starts is None:
+            starts = [0]
+            index = self.text.find('\n')
+            while index >= 0:
+                starts.append(index + 1)
+                index = self.text.find('\n', index + 1)
+            self._starts = starts
+        return self._starts
+
+    def rowcol(self, point):
+        starts = self.line_starts()
+        row = bisect.bisect_right(starts, point) - 1
+        return row, point - starts[row]
+
+    def text_point(self, row, col):
+        starts = self.line_starts()
+        if row >= len(starts):
+            return len(self.text)
+        return min(starts[row] + col, len(self.text))
+
+    def line(self, point):
+        start = self.text_point(self.rowcol(point)[0], 0)
+        end = self.text.find('\n', start)
+        return Region(start, len(self.text) if end < 0 else end)
+
+    def sel(self):
+        return self._sel
+
+    def show(self, location):
+        pass
+
+    def viewport_position(self):
+        return self._viewport
+
+    def set_viewport_position(self, position, animate=True):
+        self._viewport = position
+
+    def edited(self, text):
+        self.text = text
+        self._starts = None
+        self._changes += 1
+
+    def insert(self, edit, point, text):
+        self.edited(self.text[:point] + text + self.text[point:])
+        return len(text)
+
+    def erase(self, edit, region):
+        self.edited(self.text[:region.begin()] + self.text[region.end():])
+
+    def replace(self, edit, region, text):
+        self.edited(self.text[:region.begin()] + text + self.text[region.end():])
+
+    def add_regions(self, key, regions, *args, **kwargs):
+        self._regions[key] = list(regions)
+
+    def get_regions(self, key):
+        return self._regions.get(key, [])
+
+    def erase_regions(self, key):
+        self._regions.pop(key, None)
+
+    def run_command(self, name, args=None):
+        if name == 'select_all':
+            self._sel[:] = [Region(0, self.size())]
+        elif name == 'insert':
+            region = self._sel[0]
+            self.replace(None, region, args['characters'])
+        else:
+            run_text_command(self, name, args or {})
+
+class Window(object):
+    def __init__(self):
+        self.views_by_group = {}
+        self._views = []
+        self.layout = {'cols' : [0.0, 1.0], 'rows' : [0.0, 1.0], 'cells' : [[0, 0, 1, 1]]}
+
+    def id(self):
+        return 1
+
+    def views(self):
+        return list(self._views)
+
+    def new_file(self):
+        view = View(self)
+        self._views.append(view)
+        self.views_by_group[view.id()] = 0
+        return view
+
+    def open_file(self, filename):
+        view = View(self, filename)
+        self._views.append(view)
+        self.views_by_group[view.id()] = 0
+        return view
+
+    def active_view(self):
+        return self._views[0] if self._views else None
+
+    def active_group(self):
+        return 0
+
+    def focus_view(self, view):
+        pass
+
+    def focus_group(self, group):
+        pass
+
+    def get_layout(self):
+        return self.layout
+
+    def set_layout(self, layout):
+        self.layout = layout
+
+    def num_groups(self):
+        return len(self.layout['cells'])
+
+    def get_view_index(self, view):
+        group = self.views_by_group.get(view.id(), -1)
+        return group, 0
+
+    def set_view_index(self, view, group, index):
+        self.views_by_group[view.id()] = group
+
+    def views_in_group(self, group):
+        return [v for v in self._views if self.views_by_group.get(v.id()) == group]
+
+    def show_quick_panel(self, items, on_done, *args):
+        pass
+
+    def run_command(self, name, args=None):
+        if name == 'close_by_index':
+            for view in self.views_in_group(args['group']):
+                self._views.remove(view)
+                del self.views_by_group[view.id()]
+                return
+
+# a command name like 'debug_output' runs the plugin's DebugOutputCommand
+def run_text_command(view, name, args):
+    class_name = ''.join(part.capitalize() for part in name.split('_')) + 'Command'
+    command = getattr(sys.modules['plugin'], class_name)(view)
+    command.run(None, **args)
+
+class TextCommand(object):
+    def __init__(self, view):
+        self.view = view
+
+class WindowCommand(object):
+    def __init__(self, window):
+        self.window = window
+
+class EventListener(object):
+    pass
+
+def stub_sublime():
+    timeouts = []
+    settings = {}
+    window = Window()
+    sublime = types.ModuleType('sublime')
+    sublime.Region = Region
+    sublime.DRAW_EMPTY = 1
+    sublime.HIDDEN = 128
+    sublime.PERSISTENT = 16
+    sublime.set_timeout = lambda callback, delay=0: timeouts.append(callback)
+    sublime.load_settings = lambda name: settings.setdefault(name, Settings())
+    sublime.active_window = lambda: window
+    sublime.windows = lambda: [window]
+    sublime.status_message = lambda message: None
+    sublime.timeouts = timeouts
+    sublime_plugin = types.ModuleType('sublime_plugin')
+    sublime_plugin.TextCommand = TextCommand
+    sublime_plugin.WindowCommand = WindowCommand
+    sublime_plugin.EventListener = EventListener
+    sys.modules['sublime'] = sublime
+    sys.modules['sublime_plugin'] = sublime_plugin
+    return sublime
+
+# what the ui thread does between batches of messages
+def run_timeouts(sublime):
+    while sublime.timeouts:
+        callbacks = sublime.timeouts[:]
+        del sublime.timeouts[:]
+        for callback in callbacks:
+            callback()
+
+def encode(cmd, data):
+    return (json.dumps({'command' : cmd, 'data' : data}) + '\n').encode('utf-8')
+
+#-----------------------------------------------------------------------------
+# plugin.py's handling of the debugger's messages
+
+def bench_render(quick, directory):
+    sublime = stub_sublime()
+    # no spare debugger.py, nothing is run
+    sublime.load_settings('python-debugger').set('warm_start', False)
+    import plugin
+    size = dict((name, sizes[1 if quick else 0]) for name, sizes in SIZES.items())
+    target = write_script(directory, 'render', ''.join('x{0} = {0}\n'.format(i) for i in range(1000)))
+
+    session = plugin.Debugger(plugin.sessions, 1)
+    session.output_pane = plugin.DebugWindow('Output', group=1, max_lines=10000)
+    session.stack_pane = plugin.DebugWindow('Call Stack', group=2)
+    session.variables_pane = plugin.DebugWindow('Variables', group=3)
+    session._mode = 'debug'
+
+    def handle(messages):
+        start = time.time()
+        session.feed(b''.join(messages))
+        run_timeouts(sublime)
+        return time.time() - start
+
+    # output arrives in batches of 50 lines
+    chunk = ''.join('output line {0} {1}\n'.format(i, 'x' * 60) for i in range(50))
+    message = encode('output', chunk)
+    seconds = sum(handle([message]) for _ in range(size['output_messages']))
+    results = {
+        'output' : {
+            'lines' : 50 * size['output_messages'],
+            'seconds' : seconds,
+            'lines_per_s' : 50 * size['output_messages'] / seconds,
+        }
+    }
+
+    # a stop 500 frames deep, with its first page of frames
+    stack = [{'filename' : target, 'line_number' : i + 1, 'formatted' : 'f{0}'.format(i)} for i in range(20)]
+    children = [{'name' : 'v{0}'.format(i), 'type' : 'int', 'repr' : str(i * 1000), 'ref' : i % 3}
+        for i in range(100)]
+    breaks, variables = [], []
+    for stop_id in range(1, size['renders'] + 1):
+        breaks.append(handle([encode('break', {
+            'filename' : target,
+            'line_number' : stop_id % 1000 + 1,
+            'type' : 'breakpoint',
+            'msg' : '',
+            'stop_id' : stop_id,
+            'depth' : 500,
+            'stack' : stack,
+            'thread' : {'id' : 1, 'name' : 'MainThread'},
+        })]))
+        variables.append(handle([encode('variables', {
+            'stop_id' : stop_id,
+            'ref' : 'locals',
+            'start' : 0,
+            'end' : 100,
+            'total' : 250,
+            'children' : children,
+        })]))
+    results['break'] = percentiles(breaks)
+    results['variables'] = percentiles(variables)
+    return results
+
+#-----------------------------------------------------------------------------
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)):
+            flat[prefix + key] = value
+    return flat
+
+def compare(old, new):
+    old, new = flatten(old['results']), flatten(new['results'])
+    lines = []
+    for key in sorted(new):
+        if key in old and old[key]:
+            change = (new[key] - old[key]) / float(old[key]) * 100
+            lines.append('{0:<50}{1:>14.4g}{2:>14.4g}{3:>+9.1f}%'.format(key, old[key], new[key], change))
+    return '\n'.join(lines)
+
+def parse_args(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmarks for the debugger and the plugin')
+    parser.add_argument('--python', default=sys.executable,
+        help='the interpreter debugger.py and the scripts run on, this one by default')
+    parser.add_argument('--engine', action='append',
+        help='only this tracing engine, bdb or monitoring. can be given more than once')
+    parser.add_argument('--quick', action='store_true', help='smaller workloads, single runs')
+    parser.add_argument('--output', default=os.path.join(tempfile.gettempdir(), 'bench-results.json'),
+        help='where the results are written, bench-results.json in the temp directory by default')
+    parser.add_argument('--compare', metavar='OLD_FILE', help='results of an earlier run to compare with')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(sys.argv[1:] if argv is None else argv)
+    version, engines = target_info(options.python)
+    if options.engine:
+        engines = [e for e in engines if e in options.engine]
+    directory = tempfile.mkdtemp(prefix='debugger-bench-')
+    try:
+        results = {
+            'debugger' : bench_debugger(options.python, engines, options.quick, directory),
+            'render' : bench_render(options.quick, directory),
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    report = {
+        'meta' : {
+            'time' : time.time(),
+            'python' : version,
+            'plugin_python' : sys.version.split()[0],
+            'platform' : platform.platform(),
+            'quick' : options.quick,
+        },
+        'results' : results,
+    }
+    with open(options.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    sys.stdout.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+    if options.compare:
+        with open(options.compare) as f:
+            sys.stdout.write(compare(json.load(f), report) + '\n')
+
+if __name__ == '__main__':
+    main()
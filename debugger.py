@@ -1,118 +1,1464 @@
 import sys
 import bdb
-import thread
+import dis
+import codecs
+import collections
+import threading
+import time
+import linecache
+import itertools
+import signal
+import string
+import traceback
+import array
+import socket
 import json
-from jsoncmd import JsonCmd
+import operator
+import select
+import re
+from jsoncmd import JsonCmd, MessageFramer, encode_message
 import os
 
-# this will be called from multiple threads. the "right" thing
-# to do is write from a single thread using a Queue, but if
-# we always write a full line at a time using os.write we should
-# be ok
-def write_command(cmd, data, fd):
-    obj = {
-        'command' : cmd,
-        'data' : data
-    }
-    os.write(fd.fileno(), json.dumps(obj) + '\n')
+try:
+    import thread
+except ImportError:
+    import _thread as thread
+
+try:
+    import reprlib
+except ImportError:
+    import repr as reprlib
+
+# the debugger's own threads go by this name and are never traced
+OWN_THREAD_NAME = 'python-debugger'
+
+def start_thread(target, *args):
+    t = threading.Thread(target=target, args=args, name=OWN_THREAD_NAME)
+    t.daemon = True
+    t.start()
+    return t
+
+# calls fn every interval for as long as it returns True. a plain sleep
+# instead of a timed wait, which polls on python 2
+def sleep_loop(interval, fn):
+    while True:
+        time.sleep(interval)
+        if not fn():
+            return
+
+def is_own_thread():
+    return threading.current_thread().name == OWN_THREAD_NAME
+
+# the plugin asks for length-prefixed messages instead of json lines
+BINARY_FRAMING = os.environ.get('PYTHON_DEBUGGER_FRAMING') == 'binary'
+
+# output is zlib compressed, set by --compress for a remote plugin
+COMPRESS_OUTPUT = False
+
+# characters of output that may wait to be written before the relay
+# thread is made to wait, which in turn blocks the script's prints
+OUTPUT_QUEUE_SIZE = 2 ** 20
+
+class MessageWriter(object):
+    """
+    The only thread that writes to the plugin. Control messages (breaks,
+    responses) are sent ahead of any queued output so a stop is never stuck
+    behind a flood of prints. Output is never dropped: once
+    OUTPUT_QUEUE_SIZE characters are waiting, send_output() blocks.
+    delayed counts output messages a control message overtook, throttled
+    counts the times send_output() had to wait. Messages are numbered in
+    the order they are written
+    """
+    def __init__(self, fd, max_output=OUTPUT_QUEUE_SIZE):
+        self.fd = fd
+        self.max_output = max_output
+        self.cond = threading.Condition()
+        self.control = collections.deque()
+        self.output = collections.deque()
+        self.output_size = 0
+        self.closed = False
+        self.delayed = 0
+        self.throttled = 0
+        self.seq = itertools.count(1)
+
+    def send(self, cmd, data):
+        with self.cond:
+            self.control.append((cmd, data))
+            self.cond.notify_all()
+
+    # bulk messages other than 'output' pass their cmd and size
+    def send_output(self, data, cmd='output', size=None):
+        if size is None:
+            size = len(data)
+        with self.cond:
+            if self.output_size >= self.max_output:
+                self.throttled += 1
+                while self.output_size >= self.max_output and not self.closed:
+                    self.cond.wait()
+            self.output.append((cmd, data, size))
+            self.output_size += size
+            self.cond.notify_all()
+
+    # everything queued before close() is still written
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def counters(self):
+        with self.cond:
+            return {'delayed' : self.delayed, 'throttled' : self.throttled}
+
+    def next_message(self):
+        with self.cond:
+            while not self.control and not self.output:
+                if self.closed:
+                    return None
+                self.cond.wait()
+            if self.control:
+                self.delayed += len(self.output)
+                return self.control.popleft()
+            cmd, data, size = self.output.popleft()
+            self.output_size -= size
+            self.cond.notify_all()
+            return cmd, data
+
+    # a SocketTransport writes whole messages itself, waiting out a
+    # reconnect when it has to
+    def run(self):
+        if hasattr(self.fd, 'sendall'):
+            write_all = self.fd.sendall
+        else:
+            fd = self.fd.fileno()
+            def write_all(data):
+                while data:
+                    data = data[os.write(fd, data):]
+        while True:
+            message = self.next_message()
+            if message is None:
+                return
+            write_all(encode_message(message[0], message[1], BINARY_FRAMING, COMPRESS_OUTPUT, next(self.seq)))
+
+# seconds between attempts to reach the plugin with --connect
+CONNECT_RETRY_INTERVAL = 0.5
+
+class CommandQueue(object):
+    """
+    Commands read ahead by a thread of their own, for JsonCmd to take with
+    readline(). A command in urgent is handled on the reader thread as
+    soon as it arrives, even while the script runs
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.lines = collections.deque()
+        self.urgent = {}
+        self.eof = False
+
+    def start(self):
+        start_thread(self.run)
+
+    def received(self, line):
+        try:
+            parsed = json.loads(line)
+            handler = self.urgent.get(parsed['command'])
+        except (ValueError, KeyError, TypeError):
+            handler = None
+        if handler is not None:
+            handler(parsed.get('data'))
+            return
+        with self.cond:
+            self.lines.append(line)
+            self.cond.notify_all()
+
+    def ended(self):
+        with self.cond:
+            self.eof = True
+            self.cond.notify_all()
+
+    def readline(self):
+        with self.cond:
+            while not self.lines and not self.eof:
+                self.cond.wait()
+            if not self.lines:
+                return ''
+            return self.lines.popleft() + '\n'
+
+    # until the connection drops
+    def read_lines(self, sock):
+        rest = b''
+        while True:
+            try:
+                data = sock.recv(2**16)
+            except socket.error:
+                return
+            if not data:
+                return
+            lines = (rest + data).split(b'\n')
+            rest = lines.pop()
+            for line in lines:
+                if line.strip():
+                    self.received(line.decode('utf-8'))
+
+class PipeReader(CommandQueue):
+    """
+    Reads the plugin's commands off stdin, so the urgent ones are handled
+    while the script runs
+    """
+    def __init__(self, fd):
+        CommandQueue.__init__(self)
+        self.fd = fd
+
+    def run(self):
+        for line in iter(self.fd.readline, ''):
+            if line.strip():
+                self.received(line.rstrip('\n'))
+        self.ended()
+
+class SocketTransport(CommandQueue):
+    """
+    Talks to the plugin over TCP instead of stdin and stdout, listening for
+    it or connecting to it. The reader thread takes a dropped connection as
+    a cue to wait for the next one, so a stopped script stays stopped while
+    the plugin reconnects, there is never an end of file. on_connect is
+    called for every new connection. A child's transport ends the process
+    when it loses its connection instead, with on_disconnect
+    """
+    def __init__(self, address, listen=False):
+        CommandQueue.__init__(self)
+        self.address = address
+        self.listen = listen
+        self.sock = None
+        self.on_connect = None
+        self.on_disconnect = None
+        self.server = None
+        if listen:
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server.bind(address)
+            self.server.listen(1)
+            self.address = self.server.getsockname()
+
+    def connect(self):
+        if self.listen:
+            sock = self.server.accept()[0]
+        else:
+            while True:
+                try:
+                    sock = socket.create_connection(self.address)
+                    break
+                except socket.error:
+                    time.sleep(CONNECT_RETRY_INTERVAL)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def run(self):
+        while True:
+            sock = self.connect()
+            with self.cond:
+                self.sock = sock
+                self.cond.notify_all()
+            if self.on_connect is not None:
+                self.on_connect()
+            self.read_lines(sock)
+            if self.on_disconnect is not None:
+                self.on_disconnect()
+            with self.cond:
+                if self.sock is sock:
+                    self.sock = None
+            sock.close()
+
+    # a write that fails drops the connection and is tried again on the
+    # next one
+    def sendall(self, data):
+        while True:
+            with self.cond:
+                while self.sock is None:
+                    self.cond.wait()
+                sock = self.sock
+            try:
+                sock.sendall(data)
+                return
+            except socket.error:
+                with self.cond:
+                    if self.sock is sock:
+                        self.sock = None
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+# [host:]port, the host defaults to the loopback interface
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+# output is sent once per OUTPUT_BATCH_SIZE bytes or OUTPUT_BATCH_INTERVAL
+# seconds, whichever comes first
+OUTPUT_BATCH_SIZE = 2 ** 16
+OUTPUT_BATCH_INTERVAL = 0.016
+
+class OutputBatcher(object):
+    """
+    Coalesces chunks of the script's output into few 'output' messages.
+    add() is called by the relay thread and sends once a batch is full,
+    run() sends from its own thread so a quiet script still gets its last
+    chunk flushed after the interval
+    """
+    def __init__(self, writer, max_size=OUTPUT_BATCH_SIZE, interval=OUTPUT_BATCH_INTERVAL):
+        self.writer = writer
+        self.max_size = max_size
+        self.interval = interval
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.cond = threading.Condition()
+        self.chunks = []
+        self.size = 0
+        self.closed = False
+
+    def add(self, data):
+        with self.cond:
+            self.chunks.append(data)
+            self.size += len(data)
+            if self.size >= self.max_size:
+                self.flush()
+            elif len(self.chunks) == 1:
+                self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    # must be called with self.cond held, so batches go out in order
+    def flush(self):
+        if not self.chunks:
+            return
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        self.writer.send_output(self.decoder.decode(data))
+
+    def run(self):
+        if self.wait():
+            sleep_loop(self.interval, self.flush_and_wait)
+
+    # False once closed with nothing left to send
+    def wait(self):
+        with self.cond:
+            while not self.chunks and not self.closed:
+                self.cond.wait()
+            return bool(self.chunks)
+
+    def flush_and_wait(self):
+        with self.cond:
+            self.flush()
+        return self.wait()
 
 # thread
-def relay_stdout(from_fd, to_fd):
+def relay_stdout(from_fd, writer):
+    batcher = OutputBatcher(writer)
+    sender = start_thread(batcher.run)
     while True:
         data = os.read(from_fd.fileno(), 2 ** 15)
-        if data != "":
-            write_command('output', data, to_fd)
+        if data:
+            batcher.add(data)
         else:
             from_fd.close()
+            batcher.close()
+            sender.join()
             break    
 
-# Based on Pdb
-class JsonDebugger(bdb.Bdb, JsonCmd):
-    def __init__(self, stdin, stdout):
-        bdb.Bdb.__init__(self)
-        JsonCmd.__init__(self, stdin=stdin, stdout=stdout)
-        self.stdout = stdout
-        self.stdin = stdin
-        self.first_time = True
+# logpoint messages past LOGPOINT_RATE a second are counted and dropped
+LOGPOINT_RATE = 5000
+
+class LogpointBatcher(object):
+    """
+    Collects logpoint messages from the script's thread and sends them as
+    one bulk 'logpoint' message per OUTPUT_BATCH_INTERVAL. allow() is
+    asked before a message is formatted, so a dropped hit costs little.
+    The sending thread is started with the first hit
+    """
+    def __init__(self, writer, rate=LOGPOINT_RATE, interval=OUTPUT_BATCH_INTERVAL):
+        self.writer = writer
+        self.rate = rate
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.messages = []
+        self.size = 0
+        self.dropped = 0
+        self.second = 0
+        self.count = 0
+        self.closed = False
+        self.thread = None
+
+    def allow(self):
+        with self.cond:
+            now = int(time.time())
+            if now != self.second:
+                self.second = now
+                self.count = 0
+            if self.count >= self.rate:
+                self.dropped += 1
+                self.wake()
+                return False
+            self.count += 1
+            return True
+
+    def add(self, filename, line_number, text):
+        with self.cond:
+            self.messages.append({
+                'filename' : filename,
+                'line_number' : line_number,
+                'text' : text,
+            })
+            self.size += len(text)
+            self.wake()
+
+    # must be called with self.cond held
+    def wake(self):
+        if self.thread is None:
+            self.thread = start_thread(self.run)
+        self.cond.notify()
+
+    def run(self):
+        if self.wait():
+            sleep_loop(self.interval, self.flush_and_wait)
+
+    # False once closed with nothing left to send
+    def wait(self):
+        with self.cond:
+            while not self.messages and not self.dropped and not self.closed:
+                self.cond.wait()
+            return bool(self.messages or self.dropped)
+
+    def flush_and_wait(self):
+        self.flush()
+        return self.wait()
+
+    def flush(self):
+        with self.cond:
+            if not self.messages and not self.dropped:
+                return
+            data = {'messages' : self.messages, 'dropped' : self.dropped}
+            size = self.size
+            self.messages = []
+            self.size = 0
+            self.dropped = 0
+        self.writer.send_output(data, 'logpoint', size)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+class Channel(object):
+    """
+    The writer thread and the relay of the script's stdout, which goes to
+    script_fd. Threads don't survive a fork, so a checkpoint closes the
+    channel and every child opens its own. Without a script_fd the output
+    stays where it was, for a process the agent attached to
+    """
+    def __init__(self, to_fd, script_fd=None):
+        self.to_fd = to_fd
+        self.script_fd = script_fd
+
+        # everything sent to the plugin goes through one writer thread
+        self.writer = MessageWriter(to_fd)
+        self.writer_thread = start_thread(self.writer.run)
+        self.logpoints = LogpointBatcher(self.writer)
+
+        # start the stdout thread
+        self.relay = None
+        if script_fd is not None:
+            stdout_read, stdout_write = os.pipe()
+            os.dup2(stdout_write, script_fd)
+            os.close(stdout_write)
+            self.relay = start_thread(relay_stdout, os.fdopen(stdout_read, 'rb', 0), self.writer)
+
+    # the relay drains the pipe once nothing can write to it anymore. once
+    # the session is over the plugin is sent 'exited' after everything
+    # else, with the writer's counters
+    def close(self, exited=False):
+        if self.relay is not None:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, self.script_fd)
+            os.close(devnull)
+            self.relay.join()
+        self.logpoints.close()
+        if exited:
+            self.writer.send_output(self.writer.counters(), 'exited', 0)
+        self.writer.close()
+        self.writer_thread.join()
+
+# children find the hub in the environment, so the children of children
+# connect to the same one
+CHILD_HUB_ENV = 'PYTHON_DEBUGGER_CHILD_HUB'
+
+# os._exit as it was before a forked child wrapped it
+hard_exit = os._exit
+
+# the debugger's own stdin and stdout as file_ids, so a spawned child can
+# tell the ones it inherited from ones the script gave it
+PLUGIN_FILES_ENV = 'PYTHON_DEBUGGER_PLUGIN_FILES'
+
+def file_id(fd):
+    try:
+        st = os.fstat(fd)
+    except OSError:
+        return None
+    return '%d:%d' % (st.st_dev, st.st_ino)
+
+class ChildHub(object):
+    """
+    Where the debuggers of the python processes the script starts connect,
+    on the loopback interface. One thread reads all of them, and whatever a
+    read brings in reaches the plugin as one 'child' message with the
+    child's id and its messages, [cmd, data] pairs, or with closed set once
+    the child is gone. forward() passes a line from the plugin on to a child
+    """
+    def __init__(self, writer):
+        self.writer = writer
+        self.lock = threading.Lock()
+        self.children = {}
+        self.ids = itertools.count(1)
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(socket.SOMAXCONN)
+        self.address = '%s:%d' % self.server.getsockname()[:2]
+        start_thread(self.run)
+
+    def forward(self, data):
+        with self.lock:
+            sock = self.children.get(data['id'])
+        if sock is not None:
+            try:
+                sock.sendall(data['line'].encode('utf-8'))
+            except socket.error:
+                pass
+
+    def run(self):
+        framers = {}
+        while True:
+            readable = select.select([self.server] + list(framers), [], [])[0]
+            for sock in readable:
+                if sock is self.server:
+                    conn = self.server.accept()[0]
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    child_id = next(self.ids)
+                    framers[conn] = (child_id, MessageFramer())
+                    with self.lock:
+                        self.children[child_id] = conn
+                    continue
+                child_id, framer = framers[sock]
+                try:
+                    data = sock.recv(2 ** 16)
+                except socket.error:
+                    data = b''
+                if not data:
+                    del framers[sock]
+                    with self.lock:
+                        del self.children[child_id]
+                    sock.close()
+                    self.writer.send_output({'id' : child_id, 'messages' : [], 'closed' : True}, 'child', 0)
+                    continue
+                messages = []
+                for kind, payload in framer.feed(data):
+                    parsed = json.loads(payload.decode('utf-8'))
+                    messages.append([parsed['command'], parsed['data']])
+                if messages:
+                    self.writer.send_output({'id' : child_id, 'messages' : messages}, 'child', len(data))
+
+# python's own options that take a value, joined to them or the next
+# argument
+PYTHON_VALUE_OPTIONS = 'WXQ'
+
+def is_python(program):
+    return re.match(r'python[0-9.]*w?(\.exe)?$', os.path.basename(program).lower()) is not None
+
+# the args of a python interpreter with debugger.py between its options
+# and the script, -c or -m it runs, or None for the interactive
+# interpreter and a script read from stdin
+def child_command(args, hub_address):
+    args = list(args)
+    i = 1
+    while i < len(args):
+        arg = args[i]
+        if arg in ('-c', '-m') or not arg.startswith('-'):
+            break
+        if arg in ('-', '--'):
+            return None
+        if arg == '--check-hash-based-pycs':
+            i += 1
+        elif not arg.startswith('--'):
+            for j, flag in enumerate(arg[1:]):
+                # -c or -m joined to other flags isn't worth untangling
+                if flag in 'cm':
+                    return None
+                if flag in PYTHON_VALUE_OPTIONS:
+                    if j == len(arg) - 2:
+                        i += 1
+                    break
+        i += 1
+    if i >= len(args) or (args[i] in ('-c', '-m') and i + 1 >= len(args)):
+        return None
+    debugger_path = os.path.abspath(__file__).replace('.pyc', '.py')
+    return args[:i] + [debugger_path, '--child', hub_address, '--'] + args[i:]
+
+def code_lines(code):
+    lines = set(lineno for _, lineno in dis.findlinestarts(code))
+    # bdb also matches a breakpoint on the first line of a function
+    lines.add(code.co_firstlineno)
+    return lines
+
+# conditions and logpoint expressions are compiled once, however many
+# breakpoints share them
+_expression_cache = {}
+
+def compile_expression(source):
+    code = _expression_cache.get(source)
+    if code is None:
+        code = compile(source, '<breakpoint expression>', 'eval')
+        _expression_cache[source] = code
+    return code
+
+class LogMessage(object):
+    """
+    A logpoint template in str.format syntax, where each field is a python
+    expression evaluated in the frame: 'i={i} total={sum(values):.2f}'
+    """
+    def __init__(self, template):
+        self.parts = []
+        for literal, field, spec, conversion in string.Formatter().parse(template):
+            code = compile_expression(field) if field else None
+            self.parts.append((literal, code, spec, conversion))
+
+    def format(self, frame):
+        out = []
+        for literal, code, spec, conversion in self.parts:
+            out.append(literal)
+            if code is None:
+                continue
+            try:
+                value = eval(code, frame.f_globals, frame.f_locals)
+                if conversion == 'r':
+                    value = repr(value)
+                elif conversion == 's':
+                    value = str(value)
+                out.append(format(value, spec or ''))
+            except Exception:
+                out.append('<{0}>'.format(sys.exc_info()[0].__name__))
+        return ''.join(out)
+
+class BreakpointCondition(object):
+    """
+    Decides in the script's process whether a breakpoint hit stops, so a
+    hit that doesn't only costs an eval. The first ignore_count hits that
+    pass the condition are skipped, then every hit_count'th one stops, or
+    for a logpoint has its log message sent instead
+    """
+    def __init__(self, condition=None, hit_count=0, ignore_count=0, log=None):
+        self.condition = condition
+        self.code = compile_expression(condition) if condition else None
+        self.hit_count = hit_count or 0
+        self.ignore_count = ignore_count or 0
+        self.log = LogMessage(log) if log else None
+        self.hits = 0
+
+    def matches(self, frame):
+        if self.code is not None:
+            try:
+                if not eval(self.code, frame.f_globals, frame.f_locals):
+                    return False
+            except Exception:
+                # like bdb, a condition that raises stops
+                return True
+        self.hits += 1
+        if self.hits <= self.ignore_count:
+            return False
+        if self.hit_count and (self.hits - self.ignore_count) % self.hit_count:
+            return False
+        return True
+
+class BreakpointIndex(object):
+    """
+    Breakpoint lines keyed by canonical filename, with a cache of which
+    code objects contain one. A frame whose code has no breakpoint line
+    can never stop while continuing, so it doesn't need a local tracer.
+    Breakpoints with a condition or hit counts also have an entry in
+    conditions, keyed by (filename, line_number)
+    """
+    def __init__(self, canonic):
+        self.canonic = canonic
+        self.files = {}
+        self.conditions = {}
+        self._code_cache = {}
+
+    def add(self, filename, line_number, condition=None):
+        filename = self.canonic(filename)
+        self.files.setdefault(filename, set()).add(line_number)
+        if condition is not None:
+            self.conditions[(filename, line_number)] = condition
+        else:
+            self.conditions.pop((filename, line_number), None)
+        self._code_cache.clear()
+
+    def remove(self, filename, line_number):
+        filename = self.canonic(filename)
+        self.conditions.pop((filename, line_number), None)
+        lines = self.files.get(filename)
+        if lines is None:
+            return
+        lines.discard(line_number)
+        if not lines:
+            del self.files[filename]
+        self._code_cache.clear()
+
+    def may_break(self, code):
+        try:
+            return self._code_cache[code]
+        except KeyError:
+            pass
+        lines = self.files.get(self.canonic(code.co_filename))
+        result = bool(lines) and not lines.isdisjoint(code_lines(code))
+        self._code_cache[code] = result
+        return result
+
+class DetachedIndex(BreakpointIndex):
+    """
+    The index of a detached tracer: a thread that asks whether it may break
+    is told no and stops tracing itself, so the process goes back to full
+    speed without a check on the tracer's hot path
+    """
+    def may_break(self, code):
+        sys.settrace(None)
+        return False
+
+# samples a second, seconds between the reports sent while profiling,
+# and how many entries each table of a report has
+PROFILE_RATE = 200
+PROFILE_REPORT_INTERVAL = 0.5
+PROFILE_TOP = 50
+
+class Sampler(object):
+    """
+    Samples the stack of one thread from a thread of its own. Samples are
+    folded as they are taken into counts per function (self and total),
+    per line and per stack, and the plugin gets a 'profile' report of the
+    top entries every report_interval seconds, never one per sample.
+    Frames from bottom up are the debugger's own and aren't counted
+    """
+    def __init__(self, thread_id, writer, bottom, rate=PROFILE_RATE, report_interval=PROFILE_REPORT_INTERVAL):
+        self.thread_id = thread_id
+        self.writer = writer
+        self.bottom = bottom
+        # debugger.py's own frames above bottom, run_script and the like
+        self.own_files = set([bottom.f_code.co_filename])
+        self.interval = 1.0 / rate
+        self.report_interval = report_interval
+        self.next_report = None
+        self.stopped = False
+        self.samples = 0
+        self.self_counts = collections.defaultdict(int)
+        self.total_counts = collections.defaultdict(int)
+        self.line_counts = collections.defaultdict(int)
+        self.stack_counts = collections.defaultdict(int)
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None and frame is not self.bottom:
+            if frame.f_code.co_filename not in self.own_files:
+                stack.append((frame.f_code, frame.f_lineno))
+            frame = frame.f_back
+        if not stack:
+            return
+        self.samples += 1
+        code, line_number = stack[0]
+        self.self_counts[code] += 1
+        self.line_counts[(code.co_filename, line_number)] += 1
+        codes = [c for c, _ in stack]
+        for c in set(codes):
+            self.total_counts[c] += 1
+        self.stack_counts[tuple(reversed(codes))] += 1
+
+    def run(self):
+        self.next_report = time.time() + self.report_interval
+        sleep_loop(self.interval, self.tick)
+
+    def tick(self):
+        if self.stopped:
+            return False
+        self.sample()
+        if time.time() >= self.next_report:
+            self.report()
+            self.next_report = time.time() + self.report_interval
+        return True
+
+    def stop(self):
+        self.stopped = True
+
+    def report(self, done=False):
+        def top(counts):
+            return sorted(counts.items(), key=lambda item: item[1], reverse=True)[:PROFILE_TOP]
+        self.writer.send('profile', {
+            'samples' : self.samples,
+            'done' : done,
+            'functions' : [{
+                'name' : code.co_name,
+                'filename' : code.co_filename,
+                'line_number' : code.co_firstlineno,
+                'self' : self.self_counts.get(code, 0),
+                'total' : count,
+            } for code, count in top(self.total_counts)],
+            'lines' : [{
+                'filename' : filename,
+                'line_number' : line_number,
+                'count' : count,
+            } for (filename, line_number), count in top(self.line_counts)],
+            'stacks' : [{
+                'stack' : ';'.join(code.co_name for code in stack),
+                'count' : count,
+            } for stack, count in top(self.stack_counts)],
+        })
+
+# seconds between the line count deltas sent in heat mode
+HEAT_INTERVAL = 0.25
+
+class LineCounter(object):
+    """
+    Counts line executions in the files the plugin has open, in an array
+    per file indexed by line number. Code from any other file is never
+    traced. A sender thread ships what changed every interval as one
+    'heat' message of {filename : [[line_number, delta], ...]}
+    """
+    def __init__(self, writer, filenames, canonic, interval=HEAT_INTERVAL):
+        self.writer = writer
+        self.canonic = canonic
+        self.interval = interval
+        self.stopped = False
+        # the plugin's name for each watched file, by canonical name
+        self.names = dict((canonic(f), f) for f in filenames)
+        self.counts = {}
+        self.sent = {}
+        self._files = {}
+
+    # the counts for a code object's file, None if it isn't watched
+    def counts_for(self, co_filename):
+        try:
+            return self._files[co_filename]
+        except KeyError:
+            pass
+        filename = self.canonic(co_filename)
+        counts = None
+        if filename in self.names:
+            counts = self.counts.get(filename)
+            if counts is None:
+                size = len(linecache.getlines(filename)) + 2
+                counts = self.counts[filename] = array.array('L', [0]) * size
+                self.sent[filename] = array.array('L', [0]) * size
+        self._files[co_filename] = counts
+        return counts
+
+    def trace_call(self, frame, event, arg):
+        counts = self.counts_for(frame.f_code.co_filename)
+        if counts is None:
+            return None
+        def trace_line(frame, event, arg):
+            if event == 'line':
+                try:
+                    counts[frame.f_lineno] += 1
+                except IndexError:
+                    self.count_past_end(counts, frame.f_lineno)
+            return trace_line
+        return trace_line
+
+    # the array is sized from the file as linecache has it, which can be
+    # shorter than the code that runs. grown in place, tracers keep it
+    def count_past_end(self, counts, line_number):
+        counts.extend(array.array('L', [0]) * (line_number + 1 - len(counts)))
+        counts[line_number] += 1
+
+    def on_start(self, code, offset):
+        mon = sys.monitoring
+        if self.counts_for(code.co_filename) is not None:
+            mon.set_local_events(mon.COVERAGE_ID, code, mon.events.LINE)
+        return mon.DISABLE
+
+    def on_line(self, code, line_number):
+        counts = self.counts_for(code.co_filename)
+        try:
+            counts[line_number] += 1
+        except IndexError:
+            self.count_past_end(counts, line_number)
+
+    # sys.monitoring where there is one, so unwatched code runs at full speed
+    def run(self, statement, run):
+        if hasattr(sys, 'monitoring'):
+            mon = sys.monitoring
+            mon.use_tool_id(mon.COVERAGE_ID, 'sublime-python-debugger heat')
+            mon.register_callback(mon.COVERAGE_ID, mon.events.PY_START, self.on_start)
+            mon.register_callback(mon.COVERAGE_ID, mon.events.LINE, self.on_line)
+            mon.set_events(mon.COVERAGE_ID, mon.events.PY_START)
+            try:
+                run(statement)
+            finally:
+                mon.set_events(mon.COVERAGE_ID, 0)
+                mon.free_tool_id(mon.COVERAGE_ID)
+            return
+        # threads the script starts are counted too
+        threading.settrace(self.trace_call)
+        sys.settrace(self.trace_call)
+        try:
+            run(statement)
+        finally:
+            sys.settrace(None)
+            threading.settrace(None)
+
+    def send_deltas(self):
+        heat = {}
+        for filename, counts in list(self.counts.items()):
+            sent = self.sent[filename]
+            if len(sent) < len(counts):
+                sent.extend(array.array('L', [0]) * (len(counts) - len(sent)))
+            delta = []
+            for line_number in range(len(counts)):
+                count = counts[line_number]
+                if count != sent[line_number]:
+                    delta.append([line_number, count - sent[line_number]])
+                    sent[line_number] = count
+            if delta:
+                heat[self.names[filename]] = delta
+        if heat:
+            self.writer.send_output(heat, 'heat', len(heat))
+
+    def send_loop(self):
+        sleep_loop(self.interval, self.send_tick)
+
+    def send_tick(self):
+        self.send_deltas()
+        return not self.stopped
+
+    def stop(self):
+        self.stopped = True
+
+# a child of the checkpoint exits with this to be replaced by a fresh one
+RESTART_EXIT_CODE = 75
+
+# the first top level statement of a script that isn't an import
+def after_imports(filename):
+    import ast
+    with open(filename, 'rb') as f:
+        tree = ast.parse(f.read(), filename)
+    for i, node in enumerate(tree.body):
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            continue
+        if i == 0 and ast.get_docstring(tree) is not None:
+            continue
+        return min([node.lineno] + [d.lineno for d in getattr(node, 'decorator_list', [])])
+    return None
+
+# frames sent with a break, the rest are fetched with 'getframes'
+STACK_PAGE_SIZE = 20
+
+# a value's repr is cut at REPR_LIMIT characters, and a 'variables' reply
+# stops taking children once VARIABLES_BUDGET characters of repr are in it
+REPR_LIMIT = 200
+VARIABLES_BUDGET = 2 ** 14
+VARIABLES_PAGE_SIZE = 100
+
+_repr = reprlib.Repr()
+_repr.maxstring = REPR_LIMIT
+_repr.maxother = REPR_LIMIT
+
+def short_repr(value):
+    try:
+        text = _repr.repr(value)
+    except Exception:
+        text = '<repr failed: %s>' % sys.exc_info()[0].__name__
+    if len(text) > REPR_LIMIT:
+        return text[:REPR_LIMIT] + '...', True
+    return text, False
+
+def attributes(obj):
+    try:
+        return getattr(obj, '__dict__', None)
+    except Exception:
+        return None
+
+# string keys, which is what locals and globals have, are shown bare
+def key_name(key):
+    if isinstance(key, str):
+        return key
+    return short_repr(key)[0]
+
+def has_children(obj):
+    if isinstance(obj, (dict, list, tuple, set, frozenset)):
+        return len(obj) > 0
+    return bool(attributes(obj))
+
+# (name, value) pairs from start to start + count, and how many there are.
+# only the requested slice is walked, never the whole container
+def child_slice(obj, start, count):
+    if isinstance(obj, (list, tuple)):
+        end = min(len(obj), start + count)
+        return [('[%d]' % i, obj[i]) for i in range(start, end)], len(obj)
+    if isinstance(obj, dict):
+        items = getattr(obj, 'iteritems', obj.items)()
+        return [(key_name(k), v) for k, v in itertools.islice(items, start, start + count)], len(obj)
+    if isinstance(obj, (set, frozenset)):
+        values = itertools.islice(obj, start, start + count)
+        return [('<%d>' % i, v) for i, v in enumerate(values, start)], len(obj)
+    attrs = attributes(obj)
+    if not attrs:
+        return [], 0
+    names = sorted(attrs.keys())
+    return [(name, attrs[name]) for name in names[start:start + count]], len(names)
+
+class VariableHandles(object):
+    """
+    Numbers for the objects the plugin may ask the children of. The objects
+    are held until clear(), so a handle is only valid for the stop it was
+    given out in
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.objects = {}
+        self.handles = {}
+
+    def handle_for(self, obj):
+        handle = self.handles.get(id(obj))
+        if handle is None:
+            handle = len(self.objects) + 1
+            self.handles[id(obj)] = handle
+            self.objects[handle] = obj
+        return handle
+
+    def get(self, handle):
+        return self.objects[handle]
+
+class ThreadState(threading.local):
+    """
+    The stepping state of whichever thread reads it. A new thread starts
+    out with the class defaults, continuing, so one that was already
+    running when the agent attached only stops at a breakpoint. Every
+    thread's attributes are also kept in states by thread id, so an engine
+    can see what all of them do
+    """
+    stopframe = None
+    returnframe = None
+    stoplineno = 0
+    botframe = None
+    quitting = False
+    frame_returning = None
+    enterframe = None
+    trace_opcodes = False
+    continuing = True
+    stepping = False
+
+    def __init__(self, states):
+        states[thread.get_ident()] = self.__dict__
+
+    # the attribute dicts of threads that are still running, the others
+    # are pruned. an attribute still at its default isn't in its dict
+    @staticmethod
+    def live(states):
+        running = sys._current_frames()
+        for ident in list(states):
+            if ident not in running:
+                states.pop(ident, None)
+        return list(states.values())
+
+# an engine attribute with a value per thread. reads go through a C
+# attrgetter, they are on the tracer's hot path
+def per_thread(name):
+    return property(operator.attrgetter('thread_state.' + name),
+        lambda self, value: setattr(self.thread_state, name, value))
+
+class JsonDebuggerBase(JsonCmd):
+    """
+    The protocol half of the debugger: json commands in, break events out.
+    Tracing is left to an engine, which provides the bdb.Bdb stepping api
+    (set_break, clear_break, set_step, set_next, set_return, set_continue,
+    get_stack and run) with its stepping state in a ThreadState, so each of
+    the script's threads steps on its own. One thread is stopped at a time
+    """
+    def __init__(self, stdin, writer):
+        JsonCmd.__init__(self, stdin=stdin)
+        self.writer = writer
+        self.continuing = False
+        self.stop_id = 0
+        self.handles = VariableHandles()
+        self.channel = None
+        self.checkpoint = None
+        self.checkpoint_child = None
+        self.last_break = None
+        self.bp_index = BreakpointIndex(self.canonic)
+        self.stop_lock = threading.Lock()
+        self.stopped_thread = None
+        self.waiting = set()
+        self.hub = None
+        self.hub_lock = threading.Lock()
+        self.following = False
+        self.forking_checkpoint = False
+        self.is_child = False
+        self.exit_wrapped = False
+        self.exit_status = None
+        self.detached = False
+        self.own_files = set(self.canonic(f.replace('.pyc', '.py'))
+            for f in (__file__, bdb.__file__, sys.modules[JsonCmd.__module__].__file__))
         self.forget()
 
+    def canonic(self, filename):
+        if filename == "<" + filename[1:-1] + ">":
+            return filename
+        canonic = self.fncache.get(filename)
+        if not canonic:
+            canonic = os.path.normcase(os.path.abspath(filename))
+            self.fncache[filename] = canonic
+        return canonic
+
     def forget(self):
         self.lineno = None
         self.stack = []
         self.curindex = 0
         self.curframe = None
+        self.handles.clear()
 
     def setup(self, frame, traceback):
         self.forget()
         self.stack, self.curindex = self.get_stack(frame, traceback)
         self.curframe = self.stack[self.curindex][0]
 
-    def send_break(self, break_type, filename, line_number, msg):
+    # frames are numbered from the innermost one outwards
+    def stack_page(self, start, count):
         stack_json = []
-        for frame, line_no in self.stack:
+        end = len(self.stack) - start
+        for frame, line_no in reversed(self.stack[max(0, end - count):max(0, end)]):
             stack_json.append({
                 'filename' : frame.f_code.co_filename,
-                'line_number' : frame.f_lineno,
+                'line_number' : line_no,
                 'formatted' : frame.f_code.co_name or "<lambda>",
             })
-        write_command('break', {
+        return stack_json
+
+    def break_data(self, break_type, filename, line_number, msg):
+        current = threading.current_thread()
+        return {
             'filename' : filename,
             'line_number' : line_number,
             'type' : break_type,
             'msg' : msg,
-            'stack' : stack_json,
+            'stop_id' : self.stop_id,
+            'depth' : len(self.stack),
+            'stack' : self.stack_page(0, STACK_PAGE_SIZE),
+            'thread' : {'id' : current.ident, 'name' : current.name},
             #'locals' : frame.f_locals,
-        }, self.stdout)
+        }
 
-    def interaction(self, filename=None, line_number=None, break_type='trace', msg=''):
-        if filename is None:
-            filename = self.curframe.f_code.co_filename
-        if line_number is None:
-            line_number = self.curframe.f_lineno
-        self.send_break(break_type, filename, line_number, msg)
-        self.cmdloop()
-        self.forget()
+    # one thread stops at a time. another one that has to stop waits here
+    # for its turn, the rest of the script's threads run on meanwhile
+    def interaction(self, frame, traceback=None, filename=None, line_number=None, break_type='trace', msg=''):
+        ident = thread.get_ident()
+        self.waiting.add(ident)
+        with self.stop_lock:
+            self.waiting.discard(ident)
+            # the plugin detached while this thread waited its turn
+            if self.detached:
+                return
+            self.stopped_thread = ident
+            self.setup(frame, traceback)
+            self.continuing = False
+            self.stop_id += 1
+            if filename is None:
+                filename = self.curframe.f_code.co_filename
+            if line_number is None:
+                line_number = self.curframe.f_lineno
+            self.last_break = self.break_data(break_type, filename, line_number, msg)
+            self.writer.send('break', self.last_break)
+            self.cmdloop()
+            self.last_break = None
+            self.stopped_thread = None
+            self.forget()
 
-    def user_line(self, frame):
-        if self.first_time:
-            self.set_continue()
-            self.first_time = False
+    # a plugin that reconnects is sent the stop it missed
+    def resend_break(self):
+        last_break = self.last_break
+        if last_break is not None:
+            self.writer.send('break', last_break)
+
+    # the innermost frame of a running thread that isn't the debugger's
+    def script_frame(self, frame):
+        while frame is not None and self.canonic(frame.f_code.co_filename) in self.own_files:
+            frame = frame.f_back
+        return frame
+
+    # where each of the script's threads is. the one at the current stop
+    # is 'stopped', one that hit a stop of its own is 'waiting' its turn
+    def do_threads(self, data):
+        frames = sys._current_frames()
+        threads = []
+        for t in threading.enumerate():
+            if t.name == OWN_THREAD_NAME:
+                continue
+            if t.ident == self.stopped_thread:
+                frame, state = self.curframe, 'stopped'
+            else:
+                frame = self.script_frame(frames.get(t.ident))
+                state = 'waiting' if t.ident in self.waiting else 'running'
+            info = {'id' : t.ident, 'name' : t.name, 'state' : state}
+            if frame is not None:
+                info.update({
+                    'filename' : frame.f_code.co_filename,
+                    'line_number' : frame.f_lineno,
+                    'function' : frame.f_code.co_name,
+                })
+            threads.append(info)
+        self.writer.send('threads', {
+            'stop_id' : self.stop_id,
+            'threads' : threads,
+        })
+
+    # like the interpreter does at exit, the script's threads that aren't
+    # daemons are waited for. they can still stop at breakpoints
+    def join_threads(self):
+        for t in threading.enumerate():
+            if t is not threading.current_thread() and not t.daemon and t.name != OWN_THREAD_NAME:
+                t.join()
+
+    # python processes the script starts are debugged too, as sessions of
+    # their own that talk to the plugin through the hub. a forked child
+    # carries on with a copy of this debugger, a spawned one has its
+    # command line rewritten to run under debugger.py --child
+    def follow_children(self):
+        if self.following:
             return
+        self.following = True
+        import subprocess
+        popen_init = subprocess.Popen.__init__
+        debugger = self
+        # a shell command or another executable is left alone
+        def __init__(popen, args, *rest, **kwargs):
+            if isinstance(args, (list, tuple)) and len(rest) < 2 and not kwargs.get('shell') and kwargs.get('executable') is None:
+                args = debugger.child_args(args) or args
+            popen_init(popen, args, *rest, **kwargs)
+        subprocess.Popen.__init__ = __init__
 
-        self.setup(frame, None)
-        self.interaction()
+        try:
+            from multiprocessing import spawn
+        except ImportError:
+            # python 2 only forks
+            spawn = None
+        if spawn is not None:
+            get_command_line = spawn.get_command_line
+            def spawn_command_line(**kwds):
+                args = get_command_line(**kwds)
+                return self.child_args(args) or args
+            spawn.get_command_line = spawn_command_line
+
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(before=self.before_fork, after_in_child=self.after_fork_in_child)
+        elif hasattr(os, 'fork'):
+            # python 2. subprocess forks too, only to exec
+            fork = os.fork
+            execute_child = subprocess.Popen._execute_child
+            execing = threading.local()
+            def _execute_child(popen, *args):
+                execing.active = True
+                try:
+                    return execute_child(popen, *args)
+                finally:
+                    execing.active = False
+            subprocess.Popen._execute_child = _execute_child
+            def forked():
+                if getattr(execing, 'active', False):
+                    return fork()
+                self.before_fork()
+                pid = fork()
+                if pid == 0:
+                    self.after_fork_in_child()
+                return pid
+            os.fork = forked
+
+    def child_args(self, args):
+        if not args:
+            return None
+        program = args[0]
+        # multiprocessing gives the interpreter as bytes on python 3
+        if isinstance(program, bytes) and not isinstance(program, str):
+            program = os.fsdecode(program)
+        if isinstance(program, str) and is_python(program):
+            return child_command(args, self.hub_address())
+
+    # the first process to have a child runs the hub, the children of
+    # children find it in the environment. from then on the commands for
+    # children are taken off stdin as soon as they come in
+    def hub_address(self):
+        with self.hub_lock:
+            address = os.environ.get(CHILD_HUB_ENV)
+            if address is None:
+                self.hub = ChildHub(self.writer)
+                address = os.environ[CHILD_HUB_ENV] = self.hub.address
+                if isinstance(self.stdin, CommandQueue):
+                    self.stdin.urgent['child'] = self.hub.forward
+                else:
+                    reader = PipeReader(self.stdin)
+                    reader.urgent['child'] = self.hub.forward
+                    reader.start()
+                    self.stdin = reader
+            return address
+
+    # a command for a child that a stopped script read before the reader
+    # took over
+    def do_child(self, data):
+        self.hub.forward(data)
+
+    def before_fork(self):
+        if not self.forking_checkpoint:
+            self.hub_address()
 
-    def run_script(self, filename):
+    # the child has none of the threads and connections of its parent, it
+    # starts over with its own
+    def after_fork_in_child(self):
+        if self.forking_checkpoint:
+            return
+        self.hub = None
+        self.hub_lock = threading.Lock()
+        self.checkpoint = self.checkpoint_child = None
+        self.stop_lock = threading.Lock()
+        self.stopped_thread = self.last_break = None
+        self.waiting = set()
+        self.connect_to_hub(os.environ[CHILD_HUB_ENV], self.channel.script_fd, sys.argv, True)
+        # multiprocessing ends its children with os._exit, which would
+        # leave the last output and the 'exited' message unsent
+        if not self.exit_wrapped:
+            self.exit_wrapped = True
+            def _exit(status):
+                self.channel.close(exited=True)
+                hard_exit(status)
+            os._exit = _exit
+
+    # a child talks to the plugin through the hub. without the hub nobody
+    # would answer a stop, so losing it ends the child
+    def connect_to_hub(self, address, script_fd, target, forked):
+        global BINARY_FRAMING, COMPRESS_OUTPUT
+        # the hub reads json lines, whatever the plugin asked for
+        BINARY_FRAMING = COMPRESS_OUTPUT = False
+        transport = SocketTransport(parse_address(address))
+        transport.urgent['quit'] = lambda data: hard_exit(0)
+        transport.on_disconnect = lambda: hard_exit(1)
+        self.is_child = True
+        self.stdin = transport
+        self.channel = Channel(transport, script_fd)
+        self.writer = self.channel.writer
+        self.writer.send('hello', {
+            'pid' : os.getpid(),
+            'parent' : os.getppid(),
+            'target' : target,
+            'forked' : forked,
+        })
+        transport.start()
+
+    # like on python's command line, a target is a script, '-c' and code
+    # or '-m' and a module, then the arguments. sets sys.argv and
+    # sys.path[0] and returns the filename and statement for run_script
+    def prepare_target(self, target):
+        if target[0] == '-c':
+            sys.argv = ['-c'] + target[2:]
+            sys.path[0] = ''
+            return '<string>', target[1]
+        if target[0] == '-m':
+            sys.argv = [target[1]] + target[2:]
+            sys.path[0] = os.getcwd()
+            return '<string>', 'import runpy; runpy.run_module(%r, run_name="__main__", alter_sys=True)' % target[1]
+        sys.argv = target
+        sys.path[0] = os.path.dirname(target[0])
+        return target[0], None
+
+    # run is the engine's traced run unless given. the statement defaults
+    # to running the file
+    def run_script(self, filename, run=None, statement=None):
         # sanitize the environment for the script we are debugging
         import __main__
         __main__.__dict__.clear()
         __main__.__dict__.update({"__name__"    : "__main__",
-                                  "__file__"    : filename,
+                                  "__spec__"    : None,
                                   "__builtins__": __builtins__,
                                  })
 
         self.mainpyfile = self.canonic(filename)
-        statement = 'execfile(%r)' % filename
-        self.run(statement)
+        if filename != '<string>':
+            __main__.__file__ = filename
+        if statement is None:
+            # works as a statement on python 2 and a function on python 3
+            statement = 'exec(compile(open(%r, "rb").read(), %r, "exec"))' % (filename, filename)
+        (run or self.run)(statement)
+
+    def run_untraced(self, statement):
+        import __main__
+        exec(statement, __main__.__dict__)
+
+    # runs the target without tracing while a Sampler watches it
+    def do_profile(self, data):
+        filename, statement = self.prepare_target(data['target'])
+        # compiled here, an exec statement would add a frame of its own
+        if statement is None:
+            with open(filename, 'rb') as f:
+                statement = compile(f.read(), filename, 'exec')
+        sampler = Sampler(thread.get_ident(), self.writer, sys._getframe(),
+            data.get('rate') or PROFILE_RATE)
+        sampler_thread = start_thread(sampler.run)
+        try:
+            self.run_script(filename, self.run_untraced, statement)
+            self.join_threads()
+        except:
+            self.writer.send('exception', traceback.format_exc())
+        finally:
+            sampler.stop()
+            sampler_thread.join()
+            sampler.report(done=True)
+        return True
+
+    # counts line executions in the files in data['files'] while the
+    # target runs without stopping
+    def do_heat(self, data):
+        filename, statement = self.prepare_target(data['target'])
+        counter = LineCounter(self.writer, data['files'], self.canonic,
+            data.get('interval') or HEAT_INTERVAL)
+        sender = start_thread(counter.send_loop)
+        try:
+            self.run_script(filename, lambda statement: counter.run(statement, self.run_untraced), statement)
+            self.join_threads()
+        except:
+            self.writer.send('exception', traceback.format_exc())
+        finally:
+            counter.stop()
+            sender.join()
+            counter.send_deltas()
+        return True
 
     def do_start(self, data):
-        target = data['target']
         breakpoints = data['breakpoints']
         for filename in breakpoints.keys():
-            for line_number in breakpoints[filename]:
-                self.set_break(filename, line_number)
+            for bp in breakpoints[filename]:
+                self.add_breakpoint(filename, bp)
+        if data.get('children'):
+            self.follow_children()
 
         # lets simulate the environment
-        sys.argv = target
-        mainpyfile = target[0]        
-        sys.path[0] = os.path.dirname(mainpyfile)
+        mainpyfile, statement = self.prepare_target(data['target'])
+        if data.get('checkpoint') and statement is None:
+            self.set_checkpoint(mainpyfile, data['checkpoint'])
         try:
-            self.run_script(mainpyfile)
+            self.run_script(mainpyfile, statement=statement)
         except SyntaxError:
             etype, value, t = sys.exc_info()
-            msg, (filename, lineno, offset, badline) = value.args
-            self.setup(t.tb_frame, t)
-            self.interaction(
+            msg, filename, lineno = value.msg, value.filename, value.lineno
+            self.interaction(t.tb_frame, t,
                 filename=filename, 
                 line_number=lineno, 
                 break_type='syntaxerror', 
@@ -120,23 +1466,223 @@ class JsonDebugger(bdb.Bdb, JsonCmd):
             )
         except:
             etype, value, t = sys.exc_info()
-            self.setup(t.tb_frame, t)
-            self.interaction(
-                msg="{0}: {1}".format(etype.__name__, str(value)),
-                break_type='exception'
-            )
+            # a child's exit status is for its parent, as without a debugger
+            if self.is_child and etype is SystemExit:
+                self.exit_status = value.code
+            else:
+                self.interaction(t.tb_frame, t,
+                    msg="{0}: {1}".format(etype.__name__, str(value)),
+                    break_type='exception'
+                )
+        self.join_threads()
         return True
 
+    # the checkpoint is 'imports' or a {filename, line_number} location.
+    # it's tracked like a breakpoint, and only stops if one is there too.
+    # forked children can't share a socket to the plugin, so there are no
+    # checkpoints when debugging remotely, or in a child
+    def set_checkpoint(self, mainpyfile, checkpoint):
+        if not hasattr(os, 'fork') or self.channel is None or isinstance(self.stdin, SocketTransport):
+            return
+        if checkpoint == 'imports':
+            filename, line_number = mainpyfile, after_imports(mainpyfile)
+        else:
+            filename, line_number = checkpoint['filename'], checkpoint['line_number']
+        if line_number is None:
+            return
+        filename = self.canonic(filename)
+        is_break = line_number in self.bp_index.files.get(filename, ())
+        if not is_break and self.set_break(filename, line_number):
+            return
+        self.checkpoint = (filename, line_number, is_break)
+
+    # called for every stop, returns True if the script should go on
+    def at_checkpoint(self, frame):
+        if self.checkpoint is None:
+            return False
+        filename, line_number, is_break = self.checkpoint
+        if frame.f_lineno != line_number or self.canonic(frame.f_code.co_filename) != filename:
+            return False
+        self.checkpoint = None
+        # engines re-arm the frames above the current one when breakpoints
+        # change, here and when a restarted child gets its breakpoints
+        self.setup(frame, None)
+        if not is_break:
+            self.clear_break(filename, line_number)
+        # children already started would lose their hub to the restart
+        forking = self.hub is None
+        if forking:
+            self.fork_checkpoint()
+        self.forget()
+        if forking:
+            self.writer.send('checkpoint', {
+                'filename' : filename,
+                'line_number' : line_number,
+            })
+        return not is_break
+
+    # the process that forks never returns from here. it waits for each
+    # child, and forks a fresh one for as long as they exit asking for it
+    def fork_checkpoint(self):
+        self.channel.close()
+        restarting = False
+        while True:
+            self.forking_checkpoint = True
+            pid = os.fork()
+            self.forking_checkpoint = False
+            if pid == 0:
+                # 0 marks a child of the checkpoint, which can be restarted
+                self.checkpoint_child = 0
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                self.channel = Channel(self.channel.to_fd, self.channel.script_fd)
+                self.writer = self.channel.writer
+                if restarting:
+                    self.writer.send('restarted', {})
+                    # wait for the breakpoints as they are now
+                    self.cmdloop()
+                return
+            self.checkpoint_child = pid
+            signal.signal(signal.SIGTERM, self.stop_checkpoint)
+            _, status = os.waitpid(pid, 0)
+            if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != RESTART_EXIT_CODE:
+                os._exit(os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1)
+            restarting = True
+
+    def stop_checkpoint(self, signum, frame):
+        os.kill(self.checkpoint_child, signal.SIGKILL)
+        os._exit(1)
+
+    def do_restart(self, data):
+        if self.checkpoint_child != 0:
+            return
+        self.channel.close()
+        os._exit(RESTART_EXIT_CODE)
+
+    def do_resume(self, data):
+        for filename, lines in list(self.bp_index.files.items()):
+            for line_number in list(lines):
+                self.clear_break(filename, line_number)
+        for filename, breakpoints in data['breakpoints'].items():
+            for bp in breakpoints:
+                self.add_breakpoint(filename, bp)
+        return True
+
+    # bp is a line number, or a dict with line_number and optionally
+    # condition, hit_count and ignore_count
+    def add_breakpoint(self, filename, bp):
+        if not isinstance(bp, dict):
+            bp = {'line_number' : bp}
+        line_number = bp['line_number']
+        condition = None
+        if bp.get('condition') or bp.get('hit_count') or bp.get('ignore_count') or bp.get('log'):
+            try:
+                condition = BreakpointCondition(bp.get('condition'), bp.get('hit_count'),
+                    bp.get('ignore_count'), bp.get('log'))
+            except (SyntaxError, ValueError):
+                self.writer.send('breakpointerror', {
+                    'filename' : filename,
+                    'line_number' : line_number,
+                    'msg' : 'Bad condition or log message: {0}'.format(sys.exc_info()[1]),
+                })
+                condition = BreakpointCondition(None, bp.get('hit_count'), bp.get('ignore_count'))
+        if not self.set_break(filename, line_number):
+            self.bp_index.add(filename, line_number, condition)
+
+    # True if a breakpoint hit should stop. a logpoint never does
+    def breakpoint_matches(self, frame):
+        condition = self.bp_index.conditions.get((self.canonic(frame.f_code.co_filename), frame.f_lineno))
+        if condition is None:
+            return True
+        if not condition.matches(frame):
+            return False
+        if condition.log is None:
+            return True
+        logpoints = self.channel.logpoints
+        if logpoints.allow():
+            logpoints.add(frame.f_code.co_filename, frame.f_lineno, condition.log.format(frame))
+        return False
+
+    # from the agent: trace the process from here on and take the plugin's
+    # breakpoints, as {filename: [bp, ...]}
+    def do_attach(self, data):
+        self.attach()
+        for filename, bps in data.get('breakpoints', {}).items():
+            for bp in bps:
+                self.add_breakpoint(filename, bp)
+
     def do_addbreakpoint(self, data):
-        filename = data['filename']
-        line_number = data['line_number']
-        self.set_break(filename, line_number)
+        self.add_breakpoint(data['filename'], data)
 
     def do_removebreakpoint(self, data):
         filename = data['filename']
         line_number = data['line_number']
         self.clear_break(filename, line_number)
 
+    # a page asked for after the script moved on gets no frames
+    def do_getframes(self, data):
+        start = data['start']
+        frames = []
+        if data['stop_id'] == self.stop_id:
+            frames = self.stack_page(start, data.get('count', STACK_PAGE_SIZE))
+        self.writer.send('frames', {
+            'stop_id' : data['stop_id'],
+            'start' : start,
+            'frames' : frames,
+        })
+
+    # ref is 'locals' or 'globals' of a frame, numbered like getframes and
+    # defaulting to the current one, or a handle from an earlier reply
+    def variables_root(self, ref, frame_index=None):
+        if ref not in ('locals', 'globals'):
+            return self.handles.get(ref)
+        frame = self.curframe
+        if frame_index is not None:
+            frame = self.stack[len(self.stack) - 1 - frame_index][0]
+        if frame is None:
+            raise KeyError(ref)
+        if ref == 'globals':
+            return frame.f_globals
+        # a function's f_locals is a proxy on python 3.13, not a dict
+        f_locals = frame.f_locals
+        if not isinstance(f_locals, dict):
+            f_locals = dict(f_locals)
+        return f_locals
+
+    def do_variables(self, data):
+        ref = data['ref']
+        start = data.get('start', 0)
+        children = []
+        total = 0
+        if data['stop_id'] == self.stop_id:
+            try:
+                obj = self.variables_root(ref, data.get('frame'))
+            except (KeyError, IndexError):
+                obj = None
+            if obj is not None:
+                page, total = child_slice(obj, start, data.get('count', VARIABLES_PAGE_SIZE))
+                used = 0
+                for name, value in page:
+                    if used >= VARIABLES_BUDGET:
+                        break
+                    text, truncated = short_repr(value)
+                    used += len(text)
+                    children.append({
+                        'name' : name,
+                        'type' : type(value).__name__,
+                        'repr' : text,
+                        'truncated' : truncated,
+                        'ref' : self.handles.handle_for(value) if has_children(value) else 0,
+                    })
+        self.writer.send('variables', {
+            'stop_id' : data['stop_id'],
+            'ref' : ref,
+            'frame' : data.get('frame'),
+            'start' : start,
+            'end' : start + len(children),
+            'total' : total,
+            'children' : children,
+        })
+
     def do_next(self, data):
         self.set_next(self.curframe)
         return True
@@ -153,25 +1699,516 @@ class JsonDebugger(bdb.Bdb, JsonCmd):
         self.set_step()
         return True
 
-def main():
+# Based on Pdb
+class JsonDebugger(bdb.Bdb, JsonDebuggerBase):
+    """
+    sys.settrace engine, works on any interpreter. bdb's stepping state is
+    per thread, a thread the script starts traces itself from its first
+    call and runs continuing until it hits a breakpoint
+    """
+    stopframe = per_thread('stopframe')
+    returnframe = per_thread('returnframe')
+    stoplineno = per_thread('stoplineno')
+    botframe = per_thread('botframe')
+    quitting = per_thread('quitting')
+    frame_returning = per_thread('frame_returning')
+    enterframe = per_thread('enterframe')
+    trace_opcodes = per_thread('trace_opcodes')
+    continuing = per_thread('continuing')
+
+    def __init__(self, stdin, writer):
+        self.thread_states = {}
+        self.thread_state = ThreadState(self.thread_states)
+        bdb.Bdb.__init__(self)
+        JsonDebuggerBase.__init__(self, stdin, writer)
+        self.first_time = True
+        self.attached = False
+
+    def set_break(self, filename, line_number, *args, **kwargs):
+        err = bdb.Bdb.set_break(self, filename, line_number, *args, **kwargs)
+        if not err:
+            self.bp_index.add(filename, line_number)
+            self.retrace_stack()
+        return err
+
+    def clear_break(self, filename, line_number):
+        self.bp_index.remove(filename, line_number)
+        return bdb.Bdb.clear_break(self, filename, line_number)
+
+    # bdb.run() resets just before it traces the main thread, so this is
+    # where the script's other threads get traced too: every thread started
+    # from now on, and on python 3.12+ the ones already running
+    def reset(self):
+        bdb.Bdb.reset(self)
+        self.continuing = False
+        if hasattr(threading, 'settrace_all_threads'):
+            threading.settrace_all_threads(self.trace_thread)
+        else:
+            threading.settrace(self.trace_thread)
+
+    def trace_thread(self, frame, event, arg):
+        if is_own_thread():
+            sys.settrace(None)
+            return None
+        # the same state set_continue() leaves, without untracing
+        self.botframe = frame.f_back or frame
+        self.stopframe = self.botframe
+        self.returnframe = None
+        self.stoplineno = -1
+        self.continuing = True
+        sys.settrace(self.trace_dispatch)
+        return self.trace_dispatch(frame, event, arg)
+
+    # bdb untraces a thread that continues with no breakpoints left. an
+    # attached process is given new ones while it runs, so it stays traced
+    def set_continue(self):
+        if self.attached:
+            self._set_stopinfo(self.botframe, None, -1)
+        else:
+            bdb.Bdb.set_continue(self)
+        self.continuing = True
+
+    # every thread starts out continuing. before python 3.12 the threads
+    # that are already running can't be traced from here, the agent traces
+    # the main thread with trace_running() from a signal handler instead
+    def attach(self):
+        for state in ThreadState.live(self.thread_states):
+            state.clear()
+        self.first_time = False
+        self.attached = True
+        if hasattr(threading, 'settrace_all_threads'):
+            threading.settrace_all_threads(self.trace_thread)
+        else:
+            threading.settrace(self.trace_thread)
+
+    # trace the calling thread, which was running before attach()
+    def trace_running(self, frame):
+        if is_own_thread():
+            return
+        sys.settrace(self.trace_dispatch)
+        while frame is not None:
+            if frame.f_trace is None and self.bp_index.may_break(frame.f_code):
+                frame.f_trace = self.trace_dispatch
+            frame = frame.f_back
+
+    # a thread can only untrace itself. with no breakpoints left every
+    # thread is back to continuing, and its next call or line event finds
+    # the DetachedIndex, which does that
+    def detach(self):
+        self.detached = True
+        self.attached = False
+        self.clear_all_breaks()
+        self.bp_index = DetachedIndex(self.canonic)
+        for state in ThreadState.live(self.thread_states):
+            state['continuing'] = True
+        if hasattr(threading, 'settrace_all_threads'):
+            threading.settrace_all_threads(None)
+        else:
+            threading.settrace(None)
+        for frame in sys._current_frames().values():
+            while frame is not None:
+                frame.f_trace = None
+                frame = frame.f_back
+
+    def break_anywhere(self, frame):
+        return self.bp_index.may_break(frame.f_code)
+
+    # while continuing, frames that can't hit a breakpoint get no local
+    # tracer, so only the call event is paid for them, and a line can only
+    # stop at a breakpoint. this is the hot path of continue mode, keep it
+    # short: every read of the stepping state is a per thread lookup
+    def trace_dispatch(self, frame, event, arg):
+        if self.thread_state.continuing:
+            if event == 'call':
+                if not self.bp_index.may_break(frame.f_code):
+                    return None
+            elif event == 'line':
+                if not self.bp_index.may_break(frame.f_code):
+                    # returning None doesn't remove the local tracer, so do it here
+                    del frame.f_trace
+                    return None
+                if self.break_here(frame):
+                    self.user_line(frame)
+                    if self.quitting:
+                        raise bdb.BdbQuit
+                return self.trace_dispatch
+        return bdb.Bdb.trace_dispatch(self, frame, event, arg)
+
+    # once a thread steps out of its first frame only the thread's own
+    # teardown is left, which is never stepped through
+    def dispatch_return(self, frame, arg):
+        result = bdb.Bdb.dispatch_return(self, frame, arg)
+        if frame.f_back is self.botframe and not self.continuing:
+            self.set_continue()
+        return result
+
+    def set_step(self):
+        bdb.Bdb.set_step(self)
+        self.retrace_stack(force=True)
+
+    def set_next(self, frame):
+        bdb.Bdb.set_next(self, frame)
+        self.retrace_stack(force=True)
+
+    def set_return(self, frame):
+        bdb.Bdb.set_return(self, frame)
+        self.retrace_stack(force=True)
+
+    # frames further up the stack may be running untraced since the last
+    # continue. stepping can return into any of them, and a breakpoint
+    # added while stopped may land in one, or in a frame of another thread
+    def retrace_stack(self, force=False):
+        frame = self.curframe
+        while frame is not None and frame is not self.botframe:
+            if frame.f_trace is None and (force or self.bp_index.may_break(frame.f_code)):
+                frame.f_trace = self.trace_dispatch
+            frame = frame.f_back
+        if force:
+            return
+        current = thread.get_ident()
+        own = set(t.ident for t in threading.enumerate() if t.name == OWN_THREAD_NAME)
+        for ident, frame in sys._current_frames().items():
+            if ident == current or ident in own:
+                continue
+            while frame is not None:
+                if frame.f_trace is None and self.bp_index.may_break(frame.f_code):
+                    frame.f_trace = self.trace_dispatch
+                frame = frame.f_back
+
+    def user_line(self, frame):
+        if self.first_time:
+            self.set_continue()
+            self.first_time = False
+            return
+
+        if self.at_checkpoint(frame):
+            return
+        # stepping always stops, a breakpoint only if its condition holds.
+        # logpoints log either way
+        if not self.breakpoint_matches(frame) and not self.stop_here(frame):
+            return
+        self.interaction(frame)
+
+class MonitoringDebugger(JsonDebuggerBase):
+    """
+    sys.monitoring (PEP 669) engine for python 3.12+. LINE events are only
+    enabled on code objects that hold a breakpoint or are being stepped
+    through, every other location returns DISABLE and runs at full speed.
+    Events are process wide, so every thread is debugged. A location is
+    only disabled when no thread is stepping through it
+    """
+    stopframe = per_thread('stopframe')
+    stepping = per_thread('stepping')
+    continuing = per_thread('continuing')
+
+    def __init__(self, stdin, writer):
+        self.fncache = {}
+        self.thread_states = {}
+        self.thread_state = ThreadState(self.thread_states)
+        JsonDebuggerBase.__init__(self, stdin, writer)
+        self.tool_id = sys.monitoring.DEBUGGER_ID
+        self.monitoring = False
+        self.botframe = None
+        self.any_stepping = False
+        self.step_codes = set()
+        self.traced_codes = set()
+        self.own_file = self.canonic(__file__.replace('.pyc', '.py'))
+        self.thread_bottom = threading.Thread._bootstrap_inner.__code__
+
+    def get_stack(self, f, t):
+        stack = []
+        if t and t.tb_frame is f:
+            t = t.tb_next
+        while f is not None:
+            stack.append((f, f.f_lineno))
+            if f is self.botframe:
+                break
+            f = f.f_back
+        stack.reverse()
+        i = max(0, len(stack) - 1)
+        while t is not None:
+            stack.append((t.tb_frame, t.tb_lineno))
+            t = t.tb_next
+        if f is None:
+            i = max(0, len(stack) - 1)
+        return stack, i
+
+    def set_break(self, filename, line_number):
+        if not linecache.getline(self.canonic(filename), line_number):
+            return 'Line %s:%d does not exist' % (filename, line_number)
+        self.bp_index.add(filename, line_number)
+        self.arm()
+
+    def clear_break(self, filename, line_number):
+        self.bp_index.remove(filename, line_number)
+        self.arm()
+
+    def set_step(self):
+        self.stepping = True
+        self.stopframe = None
+        self.arm()
+
+    def set_next(self, frame):
+        self.stepping = False
+        self.stopframe = frame
+        self.arm()
+
+    # stopping in the caller after frame returns is a 'next' on the caller
+    def set_return(self, frame):
+        self.set_next(frame.f_back)
+
+    def set_continue(self):
+        self.stepping = False
+        self.stopframe = None
+        self.continuing = True
+        self.arm()
+
+    def run(self, cmd, globals=None, locals=None):
+        if globals is None:
+            import __main__
+            globals = __main__.__dict__
+        if locals is None:
+            locals = globals
+        self.start_monitoring()
+        self.botframe = sys._getframe()
+        self.set_continue()
+        try:
+            exec(cmd, globals, locals)
+        finally:
+            self.botframe = None
+            self.stop_monitoring()
+
+    def start_monitoring(self):
+        mon = sys.monitoring
+        events = mon.events
+        mon.use_tool_id(self.tool_id, 'sublime-python-debugger')
+        mon.register_callback(self.tool_id, events.PY_START, self.on_start)
+        mon.register_callback(self.tool_id, events.PY_RESUME, self.on_start)
+        mon.register_callback(self.tool_id, events.LINE, self.on_line)
+        mon.register_callback(self.tool_id, events.PY_RETURN, self.on_return)
+        mon.register_callback(self.tool_id, events.PY_YIELD, self.on_return)
+        mon.register_callback(self.tool_id, events.PY_UNWIND, self.on_return)
+        self.monitoring = True
+
+    # freeing the tool id turns every event off, the script runs as if
+    # it had never been debugged
+    def stop_monitoring(self):
+        self.monitoring = False
+        mon = sys.monitoring
+        for code in self.traced_codes:
+            mon.set_local_events(self.tool_id, code, 0)
+        self.traced_codes.clear()
+        mon.set_events(self.tool_id, 0)
+        mon.free_tool_id(self.tool_id)
+
+    # without a botframe the whole stack of every thread is the script's
+    def attach(self):
+        for state in ThreadState.live(self.thread_states):
+            state.clear()
+        self.start_monitoring()
+        self.set_continue()
+
+    def detach(self):
+        self.detached = True
+        self.bp_index = BreakpointIndex(self.canonic)
+        if self.monitoring:
+            self.stop_monitoring()
+
+    # recompute which events are enabled for the stepping state of all
+    # threads
+    def arm(self):
+        if not self.monitoring:
+            return
+        mon = sys.monitoring
+        events = mon.events
+        for code in self.traced_codes:
+            mon.set_local_events(self.tool_id, code, 0)
+        self.traced_codes.clear()
+
+        if self.stopframe is self.botframe:
+            self.stopframe = None
+
+        states = ThreadState.live(self.thread_states)
+        stopframes = [state['stopframe'] for state in states if state.get('stopframe') is not None]
+        self.any_stepping = any(state.get('stepping') for state in states)
+        self.step_codes = set(frame.f_code for frame in stopframes)
+        if self.any_stepping:
+            mon.set_events(self.tool_id, events.LINE)
+        elif stopframes:
+            # PY_UNWIND can't be enabled per code object
+            mon.set_events(self.tool_id, events.PY_START | events.PY_RESUME | events.PY_UNWIND)
+            for code in self.step_codes:
+                self.trace_code(code, events.LINE | events.PY_RETURN | events.PY_YIELD)
+        else:
+            mon.set_events(self.tool_id, events.PY_START | events.PY_RESUME)
+
+        # frames already running, in any thread, don't see PY_START again
+        for frame in sys._current_frames().values():
+            while frame is not None:
+                if self.bp_index.may_break(frame.f_code):
+                    self.trace_code(frame.f_code, events.LINE)
+                frame = frame.f_back
+
+        # bring back every location an earlier callback returned DISABLE for
+        mon.restart_events()
+
+    def trace_code(self, code, events):
+        mon = sys.monitoring
+        current = mon.get_local_events(self.tool_id, code)
+        mon.set_local_events(self.tool_id, code, current | events)
+        self.traced_codes.add(code)
+
+    def on_start(self, code, offset):
+        if self.bp_index.may_break(code):
+            self.trace_code(code, sys.monitoring.events.LINE)
+        return sys.monitoring.DISABLE
+
+    def on_line(self, code, line_number):
+        if self.stepping:
+            if self.canonic(code.co_filename) == self.own_file:
+                return sys.monitoring.DISABLE
+            return self.stop(sys._getframe(1))
+
+        frame = sys._getframe(1)
+        if frame is self.stopframe:
+            return self.stop(frame)
+
+        lines = self.bp_index.files.get(self.canonic(code.co_filename))
+        if lines and line_number in lines:
+            if self.breakpoint_matches(frame):
+                return self.stop(frame)
+            return None
+        # another thread may be stepping through here
+        if not self.any_stepping and code not in self.step_codes:
+            return sys.monitoring.DISABLE
+
+    def on_return(self, code, offset, arg):
+        frame = sys._getframe(1)
+        if frame is self.stopframe:
+            # carry on stepping in the caller, unless that is where the
+            # script or a thread of it was started from
+            caller = frame.f_back
+            if caller is None or caller is self.botframe or caller.f_code is self.thread_bottom:
+                self.set_continue()
+                return
+            self.stopframe = caller
+            self.arm()
+
+    def stop(self, frame):
+        if is_own_thread() or self.at_checkpoint(frame):
+            return
+        self.interaction(frame)
+
+ENGINES = {
+    'bdb' : JsonDebugger,
+    'monitoring' : MonitoringDebugger,
+}
+
+def create_debugger(stdin, writer, engine=None):
+    if not engine:
+        engine = 'monitoring' if hasattr(sys, 'monitoring') else 'bdb'
+    return ENGINES[engine](stdin, writer)
+
+# python 3 only allows unbuffered binary files
+def unbuffered(fd, mode):
+    if sys.version_info[0] < 3:
+        return os.fdopen(fd, mode, 0)
+    import io
+    return io.TextIOWrapper(io.FileIO(fd, mode), write_through=True)
+
+def parse_args(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='Debugger backend for the Sublime Text python debugger')
+    remote = parser.add_mutually_exclusive_group()
+    remote.add_argument('--listen', metavar='[HOST:]PORT',
+        help='wait for the plugin on this address instead of using stdin and stdout. '
+        'the host defaults to 127.0.0.1, anyone who can connect can run code')
+    remote.add_argument('--connect', metavar='[HOST:]PORT',
+        help='connect to the plugin on this address instead of using stdin and stdout')
+    remote.add_argument('--child', metavar='HOST:PORT',
+        help='debug the target after -- as a child of a debugged script, through its hub on this address')
+    parser.add_argument('--compress', action='store_true',
+        help='zlib compress output sent to the plugin, implies binary framing')
+    # the target's own options must not be taken for ours
+    target = []
+    if '--' in argv:
+        target = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    options = parser.parse_args(argv)
+    options.target = target
+    if options.child and not target:
+        parser.error('--child needs a target after --')
+    return options
+
+def main(argv=None):
+    global BINARY_FRAMING, COMPRESS_OUTPUT
+    options = parse_args(sys.argv[1:] if argv is None else argv)
+
     # save original fds
     stdout = sys.stdout
     stdin = sys.stdin
 
+    # over tcp the same socket carries both directions
+    transport = None
+    if options.listen or options.connect:
+        transport = SocketTransport(parse_address(options.listen or options.connect), listen=bool(options.listen))
+        stdin = stdout = transport
+        # stopping a remote session can't signal the process
+        transport.urgent['quit'] = lambda data: os._exit(0)
+    if options.compress:
+        BINARY_FRAMING = COMPRESS_OUTPUT = True
+
     # pipes for stdin/out for debugged script
-    stdout_read, stdout_write = os.pipe()
+    stdout_write = os.open(os.devnull, os.O_WRONLY)
     stdin_read, stdin_write = os.pipe()
+    # a child's channel goes to the hub
+    channel = writer = None
+    if not options.child:
+        channel = Channel(stdout, stdout_write)
+        writer = channel.writer
 
-    # start the stdout thread
-    thread.start_new_thread(relay_stdout, (os.fdopen(stdout_read, 'r', 0), stdout))
+    # redirect IO. a child keeps what it was given unless it's the
+    # debugger's own, like a subprocess' captured output
+    if options.child:
+        plugin_files = os.environ.get(PLUGIN_FILES_ENV, ',').split(',')
+        redirect = [file_id(fd) == plugin_file for fd, plugin_file in zip((0, 1), plugin_files)]
+    else:
+        os.environ[PLUGIN_FILES_ENV] = '%s,%s' % (file_id(0), file_id(1))
+        redirect = [True, True]
+    if redirect[1]:
+        sys.stdout = unbuffered(stdout_write, 'w')
+    if redirect[0]:
+        sys.stdin = unbuffered(stdin_read, 'r')
 
-    # redirect IO
-    sys.stdout = os.fdopen(stdout_write, 'w', 0)
-    sys.stdin = os.fdopen(stdin_read, 'r', 0)
+    # a spare process pays for slow imports before it's given a script
+    for name in os.environ.get('PYTHON_DEBUGGER_PRELOAD', '').split(','):
+        if name:
+            try:
+                __import__(name)
+            except Exception:
+                sys.stderr.write('Could not preload %s: %s\n' % (name, sys.exc_info()[1]))
 
-    debugger = JsonDebugger(stdin, stdout)
+    debugger = create_debugger(stdin, writer, os.environ.get('PYTHON_DEBUGGER_ENGINE'))
+    debugger.channel = channel
+    if options.child:
+        # the plugin answers the hello with the start command
+        debugger.connect_to_hub(options.child, stdout_write, options.target, False)
+    elif transport is None:
+        writer.send('ready', {})
+    else:
+        def on_connect():
+            writer.send('ready', {})
+            debugger.resend_break()
+        transport.on_connect = on_connect
+        transport.start()
+        sys.stderr.write('%s the plugin on %s:%d\n' % (('Waiting for' if transport.listen else 'Connecting to',) + tuple(transport.address[:2])))
     debugger.cmdloop()
 
+    # the relay thread drains whatever the script printed last. after that
+    # a remote plugin is told not to reconnect
+    debugger.channel.close(exited=True)
+    return debugger.exit_status
+
 if __name__ == '__main__':
     import debugger
     sys.exit(debugger.main())
\ No newline at end of file
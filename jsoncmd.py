@@ -1,11 +1,137 @@
 import json
+import struct
 import sys
+import time
+import zlib
+
+# messages are newline separated json by default. binary framing prefixes
+# each message with a kind byte and its length instead, so big payloads
+# aren't scanned for newlines and 'output' text isn't json escaped
+FRAME_HEADER = struct.Struct('>cI')
+FRAME_JSON = b'j'
+FRAME_OUTPUT = b'o'
+# zlib compressed 'output' text, read back as a FRAME_OUTPUT frame
+FRAME_COMPRESSED = b'z'
+
+# smaller output isn't worth compressing
+COMPRESS_MIN_SIZE = 512
+
+# a json message given a seq also carries it and the time it was encoded,
+# for the receiver's stats. output frames go without
+def encode_message(cmd, data, binary=False, compress=False, seq=None):
+    if binary and cmd == 'output':
+        payload = data.encode('utf-8')
+        if compress and len(payload) >= COMPRESS_MIN_SIZE:
+            payload = zlib.compress(payload)
+            return FRAME_HEADER.pack(FRAME_COMPRESSED, len(payload)) + payload
+        return FRAME_HEADER.pack(FRAME_OUTPUT, len(payload)) + payload
+    obj = {
+        'command' : cmd,
+        'data' : data
+    }
+    if seq is not None:
+        obj['seq'] = seq
+        obj['time'] = time.time()
+    payload = json.dumps(obj).encode('utf-8')
+    if binary:
+        return FRAME_HEADER.pack(FRAME_JSON, len(payload)) + payload
+    return payload + b'\n'
+
+class MessageFramer(object):
+    """
+    Splits a byte stream into (kind, payload) frames. feed() can be given
+    chunks cut anywhere, a partial message is kept until the rest arrives.
+    With binary None the framing is told by the first byte: a json line
+    starts with '{', a binary frame with its kind
+    """
+    def __init__(self, binary=False):
+        self.binary = binary
+        self.chunks = []
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        if self.binary is None:
+            if not data:
+                return []
+            self.binary = data[:1] in (FRAME_JSON, FRAME_OUTPUT, FRAME_COMPRESSED)
+        if self.binary:
+            return self.feed_binary(data)
+        return self.feed_lines(data)
+
+    # only the new chunk is searched, a long message arriving in many
+    # chunks is joined once its newline shows up
+    def feed_lines(self, data):
+        end = data.rfind(b'\n')
+        if end < 0:
+            self.chunks.append(data)
+            return []
+        self.chunks.append(data[:end])
+        lines = b''.join(self.chunks).split(b'\n')
+        self.chunks = [data[end + 1:]]
+        return [(FRAME_JSON, line) for line in lines if line.strip()]
+
+    def feed_binary(self, data):
+        buf = self.buffer
+        buf.extend(data)
+        frames = []
+        pos = 0
+        while len(buf) - pos >= FRAME_HEADER.size:
+            kind, length = FRAME_HEADER.unpack_from(buf, pos)
+            start = pos + FRAME_HEADER.size
+            if len(buf) - start < length:
+                break
+            payload = bytes(buf[start:start + length])
+            if kind == FRAME_COMPRESSED:
+                kind, payload = FRAME_OUTPUT, zlib.decompress(payload)
+            frames.append((kind, payload))
+            pos = start + length
+        del buf[:pos]
+        return frames
+
+try:
+    string_types = (str, unicode)
+except NameError:
+    string_types = (str,)
+
+def map_path(path, path_map):
+    for prefix, replacement in path_map:
+        if path.startswith(prefix):
+            return replacement + path[len(prefix):]
+    return path
+
+# rewrites the filenames in a message to or from a debugger on another
+# host, through the first prefix in path_map they begin with. those are
+# 'filename' values wherever they're nested, the 'files' list, the script
+# of a 'target', the keys of 'breakpoints' and with keyed the message's
+# own keys, which 'heat' has. nothing else is touched
+def map_paths(obj, path_map, keyed=False):
+    if isinstance(obj, list):
+        return [map_paths(v, path_map) for v in obj]
+    if not isinstance(obj, dict):
+        return obj
+    mapped = {}
+    for k, v in obj.items():
+        if keyed:
+            k = map_path(k, path_map)
+        if k == 'filename' and isinstance(v, string_types):
+            v = map_path(v, path_map)
+        elif k == 'files' and isinstance(v, list):
+            v = [map_path(f, path_map) for f in v]
+        elif k == 'target' and v and not v[0].startswith('-'):
+            v = [map_path(v[0], path_map)] + v[1:]
+        else:
+            v = map_paths(v, path_map, k == 'breakpoints')
+        mapped[k] = v
+    return mapped
 
 class JsonCmd(object):
     """
     Insipred by cmd.Cmd, uses json
     """
-    def __init__(self, stdin=None, stdout=None):
+    # (seq, time) of the message being dispatched, if its sender stamped it
+    stamp = (None, None)
+
+    def __init__(self, stdin=None, stdout=None, binary=False):
         import sys
         if stdin is not None:
             self.stdin = stdin
@@ -15,6 +141,7 @@ class JsonCmd(object):
             self.stdout = stdout
         else:
             self.stdout = sys.stdout
+        self.framer = MessageFramer(binary)
 
     def readline(self):
         while True:
@@ -32,26 +159,44 @@ class JsonCmd(object):
                 continue
             if self.onecmd(line):
                 break
+
+    # for raw chunks off a stream. complete messages are dispatched in
+    # order, stopping at the first command that returns True
+    def feed(self, data):
+        return self.dispatch_frames(self.framer.feed(data))
+
+    def dispatch_frames(self, frames):
+        for kind, payload in frames:
+            if kind == FRAME_OUTPUT:
+                self.stamp = (None, None)
+                stop = self.dispatch('output', payload.decode('utf-8', 'replace'))
+            else:
+                stop = self.onecmd(payload)
+            if stop:
+                return True
  
     def parseline(self, line):
         try:
             parsed = json.loads(line)
             cmd = parsed['command']
             data = parsed['data']
-        except ValueError, KeyError:
+        except (ValueError, KeyError):
             return None, None
+        self.stamp = (parsed.get('seq'), parsed.get('time'))
         return cmd, data
 
     def onecmd(self, line):
         cmd, data = self.parseline(line)
         if cmd is None or len(cmd) == 0:
             return self.default(line)
-        else:
-            try:
-                func = getattr(self, 'do_' + cmd)
-            except AttributeError:
-                return self.default(line)
-            return func(data)
+        return self.dispatch(cmd, data, line)
+
+    def dispatch(self, cmd, data, line=None):
+        try:
+            func = getattr(self, 'do_' + cmd)
+        except AttributeError:
+            return self.default(line or cmd)
+        return func(data)
 
     def default(self, line):
         self.stdout.write('*** %s'%line)
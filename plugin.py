@@ -5,7 +5,20 @@ import subprocess
 import functools
 import time
 import json
-from jsoncmd import JsonCmd
+import codecs
+import tempfile
+import traceback
+import select
+import errno
+import socket
+try:
+    import selectors
+except ImportError:
+    selectors = None
+import math
+import itertools
+import collections
+from jsoncmd import JsonCmd, MessageFramer, map_paths
 import util
 
 #-----------------------------------------------------------------------------
@@ -15,15 +28,218 @@ class ProcessListener(object):
     def on_data(self, proc, data):
         pass
 
+    def on_error_data(self, proc, data):
+        self.on_data(proc, data)
+
     def on_finished(self, proc):
         pass
 
+    # a remote debugger was (re)connected, nothing has been read yet
+    def on_connected(self, proc):
+        pass
+
+
+def set_nonblocking(fd):
+    import fcntl
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class IOLoop(object):
+    """
+    One thread doing the pipe I/O of every debugger process, so threads
+    don't grow with the number of sessions. Nothing blocks: each read pipe
+    has a callback that gets what was read, and an empty string at the
+    end, and writes a pipe can't take yet wait in a buffer until it can.
+    The thread exits when there is nothing left to do. A callback that
+    raises ends its pipe as if it had been closed, the other sessions go on
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.readers = {}
+        self.writers = {}
+        self.thread = None
+        self.registered = {}
+        self.selector = None
+        self.wake_read = self.wake_write = None
+        if not self.supported:
+            return
+        if selectors is not None:
+            self.selector = selectors.DefaultSelector()
+        self.wake_read, self.wake_write = os.pipe()
+        set_nonblocking(self.wake_read)
+        set_nonblocking(self.wake_write)
+
+    # select() only takes sockets on windows, pipes get a thread each there
+    @property
+    def supported(self):
+        return os.name != "nt"
+
+    def add_reader(self, fd, callback):
+        set_nonblocking(fd)
+        with self.lock:
+            self.readers[fd] = callback
+            self.start()
+        self.wake()
+
+    def add_writer(self, fd):
+        set_nonblocking(fd)
+        with self.lock:
+            self.writers[fd] = []
+
+    # it may be closed right after, so it's unregistered now
+    def remove_writer(self, fd):
+        with self.lock:
+            self.writers.pop(fd, None)
+            self.unregister(fd)
+        self.wake()
+
+    # written right away when nothing is waiting for the pipe already
+    def write(self, fd, data):
+        with self.lock:
+            pending = self.writers.get(fd)
+            if pending is None:
+                return
+            if not pending:
+                data = self.write_some(fd, data)
+                if not data:
+                    return
+            pending.append(data)
+            self.start()
+        self.wake()
+
+    # returns what the pipe didn't take, called with the lock held
+    def write_some(self, fd, data):
+        try:
+            written = os.write(fd, data)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return data
+            # the process is gone, so is whatever it was sent
+            del self.writers[fd]
+            self.unregister(fd)
+            return b''
+        return data[written:]
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def wake(self):
+        if self.wake_write is None:
+            return
+        try:
+            os.write(self.wake_write, b'.')
+        except OSError:
+            pass
+
+    def run(self):
+        while True:
+            with self.lock:
+                writers = [fd for fd, pending in self.writers.items() if pending]
+                if not self.readers and not writers:
+                    self.thread = None
+                    return
+                readers = list(self.readers.keys())
+            readable, writable = self.select(readers + [self.wake_read], writers)
+            for fd in writable:
+                with self.lock:
+                    pending = self.writers.get(fd)
+                    if pending:
+                        rest = self.write_some(fd, pending[0])
+                        if rest:
+                            pending[0] = rest
+                        else:
+                            pending.pop(0)
+            for fd in readable:
+                if fd == self.wake_read:
+                    self.read(fd)
+                    continue
+                data = self.read(fd)
+                if data is None:
+                    continue
+                callback = self.readers.get(fd)
+                if callback is None:
+                    continue
+                if not data:
+                    self.remove_reader(fd)
+                self.call(fd, callback, data)
+
+    def remove_reader(self, fd):
+        with self.lock:
+            self.readers.pop(fd, None)
+            self.unregister(fd)
+
+    # a callback that fails is called once more with the end of the pipe,
+    # so its process closes its pipes and the session finishes
+    def call(self, fd, callback, data):
+        try:
+            callback(data)
+        except Exception:
+            traceback.print_exc()
+            if not data:
+                return
+            self.remove_reader(fd)
+            try:
+                callback(b'')
+            except Exception:
+                traceback.print_exc()
+
+    def read(self, fd):
+        try:
+            return os.read(fd, 2**15)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return None
+            return b''
+
+    # the selector's registrations follow what each pipe waits for
+    def select(self, readers, writers):
+        if self.selector is None:
+            readable, writable, _ = select.select(readers, writers, [])
+            return readable, writable
+        wanted = dict((fd, selectors.EVENT_READ) for fd in readers)
+        for fd in writers:
+            wanted[fd] = wanted.get(fd, 0) | selectors.EVENT_WRITE
+        with self.lock:
+            for fd in list(self.registered.keys()):
+                if fd not in wanted:
+                    self.unregister(fd)
+            for fd, events in wanted.items():
+                # removed since the lists were taken
+                if fd not in self.readers and fd not in self.writers and fd != self.wake_read:
+                    continue
+                if fd not in self.registered:
+                    self.selector.register(fd, events)
+                elif self.registered[fd] != events:
+                    self.selector.modify(fd, events)
+                self.registered[fd] = events
+        readable, writable = [], []
+        for key, events in self.selector.select():
+            if events & selectors.EVENT_READ:
+                readable.append(key.fd)
+            if events & selectors.EVENT_WRITE:
+                writable.append(key.fd)
+        return readable, writable
+
+    # before the fd is closed, the number can come back for another pipe.
+    # called with the lock held
+    def unregister(self, fd):
+        if self.registered.pop(fd, None) is not None:
+            try:
+                self.selector.unregister(fd)
+            except (KeyError, ValueError, OSError):
+                pass
+
 
 class InteractiveAsyncProcess(object):
-    def __init__(self, arg_list, env, listener, path=""):
+    def __init__(self, arg_list, env, listener, path="", loop=None):
 
         self.listener = listener
         self.killed = False
+        self.loop = None
 
         self.start_time = time.time()
 
@@ -51,6 +267,13 @@ class InteractiveAsyncProcess(object):
         if path:
             os.environ["PATH"] = old_path
 
+        if loop is not None and loop.supported:
+            self.loop = loop
+            loop.add_writer(self.proc.stdin.fileno())
+            loop.add_reader(self.proc.stdout.fileno(), self.stdout_data)
+            loop.add_reader(self.proc.stderr.fileno(), self.stderr_data)
+            return
+
         if self.proc.stdout:
             threading.Thread(target=self.read_stdout).start()
 
@@ -60,6 +283,8 @@ class InteractiveAsyncProcess(object):
     def kill(self):
         if not self.killed:
             self.killed = True
+            if self.loop is not None:
+                self.loop.remove_writer(self.proc.stdin.fileno())
             self.proc.terminate()
             self.listener = None
 
@@ -72,35 +297,239 @@ class InteractiveAsyncProcess(object):
     def read_stdout(self):
         while True:
             data = os.read(self.proc.stdout.fileno(), 2**15)
-
-            if len(data) > 0:
-                if self.listener:
-                    self.listener.on_data(self, data)
-            else:
-                self.proc.stdout.close()
-                if self.listener:
-                    self.listener.on_finished(self)
+            self.stdout_data(data)
+            if len(data) == 0:
                 break
 
     def read_stderr(self):
         while True:
             data = os.read(self.proc.stderr.fileno(), 2**15)
-
-            if len(data) > 0:
-                if self.listener:
-                    self.listener.on_data(self, data)
-            else:
-                self.proc.stderr.close()
+            self.stderr_data(data)
+            if len(data) == 0:
                 break 
 
+    def stdout_data(self, data):
+        if len(data) > 0:
+            if self.listener:
+                self.listener.on_data(self, data)
+        else:
+            # the process exited, nothing more can be written to it
+            if self.loop is not None:
+                self.loop.remove_writer(self.proc.stdin.fileno())
+            self.proc.stdout.close()
+            if self.listener:
+                self.listener.on_finished(self)
+
+    def stderr_data(self, data):
+        if len(data) > 0:
+            if self.listener:
+                self.listener.on_error_data(self, data)
+        else:
+            self.proc.stderr.close()
+
     def write_stdin(self, data):
+        if self.loop is not None:
+            self.loop.write(self.proc.stdin.fileno(), data)
+            return len(data)
         ret = os.write(self.proc.stdin.fileno(), data)
         self.proc.stdin.flush()
         return ret
 
+
+# seconds between attempts to reach a remote debugger, and how long to
+# keep trying before the session is given up
+RECONNECT_INTERVAL = 0.5
+RECONNECT_TIMEOUT = 30
+
+class RemoteProcess(object):
+    """
+    A debugger.py on another host, started with --listen, in place of an
+    InteractiveAsyncProcess. A dropped connection is retried in the
+    background until the debugger says it has 'exited'. The debugger sends
+    'ready' and the stop it's at on every new connection, commands written
+    while there is none wait for the next
+    """
+    def __init__(self, address, listener, loop=None):
+        self.address = address
+        self.listener = listener
+        self.loop = loop if loop is not None and loop.supported else None
+        self.killed = False
+        self.exited = False
+        self.sock = None
+        self.pending = []
+        self.lock = threading.Lock()
+        self.start_connect()
+
+    def start_connect(self):
+        thread = threading.Thread(target=self.connect)
+        thread.daemon = True
+        thread.start()
+
+    def connect(self):
+        deadline = time.time() + RECONNECT_TIMEOUT
+        while True:
+            if self.killed:
+                return
+            try:
+                sock = socket.create_connection(self.address, RECONNECT_INTERVAL * 10)
+                break
+            except socket.error:
+                if time.time() > deadline:
+                    self.error_data("[Could not connect to {0}:{1}]\n".format(*self.address))
+                    self.finished()
+                    return
+                time.sleep(RECONNECT_INTERVAL)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.listener:
+            self.listener.on_connected(self)
+        with self.lock:
+            self.sock = sock
+            pending, self.pending = self.pending, []
+        if self.loop is not None:
+            self.loop.add_writer(sock.fileno())
+            self.loop.add_reader(sock.fileno(), functools.partial(self.socket_data, sock))
+        else:
+            threading.Thread(target=self.read_socket, args=(sock,)).start()
+        for data in pending:
+            self.write_stdin(data)
+
+    def read_socket(self, sock):
+        while True:
+            try:
+                data = sock.recv(2**15)
+            except socket.error:
+                data = b''
+            self.socket_data(sock, data)
+            if len(data) == 0:
+                break
+
+    def socket_data(self, sock, data):
+        if len(data) > 0:
+            if self.listener:
+                self.listener.on_data(self, data)
+            return
+        with self.lock:
+            if self.sock is sock:
+                self.sock = None
+        if self.loop is not None:
+            self.loop.remove_writer(sock.fileno())
+        sock.close()
+        if self.killed or self.exited:
+            self.finished()
+            return
+        self.error_data("[Connection lost, reconnecting]\n")
+        self.start_connect()
+
+    def error_data(self, text):
+        if self.listener:
+            self.listener.on_error_data(self, text.encode('utf-8'))
+
+    def finished(self):
+        if self.listener:
+            self.listener.on_finished(self)
+
+    def write_stdin(self, data):
+        with self.lock:
+            sock = self.sock
+            if sock is None:
+                self.pending.append(data)
+                return len(data)
+        if self.loop is not None:
+            self.loop.write(sock.fileno(), data)
+        else:
+            try:
+                sock.sendall(data)
+            except socket.error:
+                pass
+        return len(data)
+
+    # there is no process to terminate, the debugger is asked to exit and
+    # closes the connection itself
+    def kill(self):
+        if not self.killed:
+            self.write_stdin(json.dumps({'command' : 'quit', 'data' : ''}) + '\n')
+            self.killed = True
+            self.listener = None
+
+    def poll(self):
+        return not (self.killed or self.exited)
+
+
+class ChildProcess(object):
+    """
+    The process of a child session: a python process started by the
+    parent session's script. Its debugger talks to the plugin through the
+    parent's, which takes the lines for it wrapped in 'child' commands
+    """
+    def __init__(self, parent, child_id):
+        self.parent = parent
+        self.child_id = child_id
+
+    def write_stdin(self, data):
+        self.parent.write_to_target(json.dumps({
+            'command' : 'child',
+            'data' : {'id' : self.child_id, 'line' : data},
+        }) + '\n')
+
+    def kill(self):
+        self.write_stdin(json.dumps({'command' : 'quit', 'data' : {}}) + '\n')
+
+class SpareProcess(ProcessListener):
+    """
+    A debugger.py started ahead of time that idles until a session takes
+    it. What it writes before then is held and handed over in order. key
+    is what it was launched with, a spare is only used for the same
+    """
+    def __init__(self, arg_list, env, loop=None):
+        self.key = (tuple(arg_list), tuple(sorted(env.items())))
+        self.lock = threading.Lock()
+        self.listener = None
+        self.held = []
+        self.finished = False
+        self.spawn_time = time.time()
+        self.ready_time = None
+        self.proc = InteractiveAsyncProcess(arg_list, env, self, loop=loop)
+
+    # returns the process and the seconds of startup it saves the caller
+    def take(self, listener):
+        now = time.time()
+        with self.lock:
+            self.listener = listener
+            for name, data in self.held:
+                getattr(listener, name)(self.proc, *data)
+            self.held = []
+        return self.proc, (self.ready_time or now) - self.spawn_time
+
+    def kill(self):
+        self.proc.kill()
+
+    def forward(self, name, *data):
+        with self.lock:
+            if self.listener is None:
+                if self.ready_time is None:
+                    self.ready_time = time.time()
+                self.held.append((name, data))
+                if name == 'on_finished':
+                    self.finished = True
+            else:
+                getattr(self.listener, name)(self.proc, *data)
+
+    def on_data(self, proc, data):
+        self.forward('on_data', data)
+
+    def on_error_data(self, proc, data):
+        self.forward('on_error_data', data)
+
+    def on_finished(self, proc):
+        self.forward('on_finished')
+
 #-----------------------------------------------------------------------------
 # Main debugger interface
 
+# milliseconds between ui updates with data from the debugged process
+OUTPUT_INTERVAL = 16
+
 class Marker(object):
     def __init__(self, name, scope="string", icon="dot", flags=sublime.DRAW_EMPTY):
         self.name = name
@@ -135,9 +564,9 @@ class Marker(object):
 class DebugLayout(object):
     defaults = {
         'layout' : {
-            "cols": [0.0, 0.5, 1.0],
+            "cols": [0.0, 0.4, 0.7, 1.0],
             "rows": [0.0, 0.7, 1.0],
-            "cells": [[0, 0, 2, 1], [0, 1, 1, 2], [1, 1, 2, 2]]
+            "cells": [[0, 0, 3, 1], [0, 1, 1, 2], [1, 1, 2, 2], [2, 1, 3, 2]]
         },
         'layout-sdfsf' : {
             "cols": [0.0, 0.4, 0.8, 1.0],
@@ -199,8 +628,13 @@ class DebugLayout(object):
 
 # this class is influenced by ReplView in SublimeREPL
 class DebugWindow(object):
-    def __init__(self, name, interactive=False, group=None, window=None):
+    def __init__(self, name, interactive=False, group=None, window=None, max_lines=None, log=None):
         self.interactive = interactive
+        self.max_lines = max_lines
+        self.log = log
+        self._pending = []
+        self._flush_scheduled = False
+        self._lines = None
 
         if window is None:
             window = sublime.active_window()
@@ -220,22 +654,72 @@ class DebugWindow(object):
         if group is not None:
             util.move_to_group(window, self.view, group)
 
+    # the view may have been closed by hand already
     def close(self):
         if self.view is None:
             return
+        self.flush()
         group, index = self.window.get_view_index(self.view)
-        self.window.run_command('close_by_index', {'group':group, 'index':index})
+        if group >= 0:
+            self.window.run_command('close_by_index', {'group':group, 'index':index})
         self.view = None
 
+    # appends are coalesced and written with a single edit once the current
+    # batch of messages has been processed
     def append(self, data):
-        self.view.set_read_only(False)
-        self.view.run_command('insert', {'characters':data})
-        self.view.set_read_only(True)
+        self._lines = None
+        self._pending.append(data)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            sublime.set_timeout(self.flush, 0)
+
+    def flush(self):
+        self._flush_scheduled = False
+        if self.view is None or len(self._pending) == 0:
+            return
+        data = ''.join(self._pending)
+        self._pending = []
+        if self.log is not None:
+            self.log.write(data)
+        self.view.run_command('debug_output', {'data':data, 'max_lines':self.max_lines})
         
     def clear(self):
+        self._pending = []
+        self._lines = None
         self.view.run_command('select_all')
         self.view.run_command('insert', {'characters':''})
 
+    # replaces everything, keeping the cursor on the same line
+    def set_text(self, data):
+        self._pending = []
+        self._lines = None
+        self.view.run_command('debug_replace', {'data':data})
+
+    # replaces everything like set_text, but when the pane was last drawn
+    # with set_lines only the run of lines between the unchanged head and
+    # tail is rewritten
+    def set_lines(self, lines):
+        self._pending = []
+        old = self._lines
+        self._lines = list(lines)
+        if old is None:
+            self.view.run_command('debug_replace_lines', {'start':0, 'end':None, 'lines':lines})
+            return
+        same = min(len(old), len(lines))
+        start = 0
+        while start < same and old[start] == lines[start]:
+            start += 1
+        tail = 0
+        while tail < same - start and old[-1 - tail] == lines[-1 - tail]:
+            tail += 1
+        if start == len(old) == len(lines):
+            return
+        self.view.run_command('debug_replace_lines', {
+            'start' : start,
+            'end' : len(old) - tail,
+            'lines' : lines[start:len(lines) - tail],
+        })
+
     def appendline(self, data):
         self.append(data + '\n')
 
@@ -255,24 +739,287 @@ class DebugWindow(object):
         return None
 
 
+#-----------------------------------------------------------------------------
+# Breakpoints are saved as line numbers, or as dicts with a line_number
+# when they have a condition, hit_count, ignore_count or a log message,
+# which makes them logpoints
+
+BREAKPOINT_OPTIONS = ('condition', 'hit_count', 'ignore_count', 'log')
+
+# gutter scopes for heat map lines, from the coldest to the hottest
+HEAT_SCOPES = ('comment', 'string', 'constant.numeric', 'invalid')
+
+# grade a line on a log scale against the hottest line in its file
+def heat_grade(count, top):
+    grade = int(len(HEAT_SCOPES) * math.log(count) / math.log(top + 1))
+    return min(grade, len(HEAT_SCOPES) - 1)
+
+def breakpoint_line(bp):
+    return bp['line_number'] if isinstance(bp, dict) else bp
+
+def make_breakpoint(line_number, options):
+    bp = dict((k, v) for k, v in options.items() if k in BREAKPOINT_OPTIONS and v)
+    if not bp:
+        return line_number
+    bp['line_number'] = line_number
+    return bp
+
+# gutter regions follow edits but only know their lines, the options of
+# saved breakpoints are matched back to them in order
+def moved_breakpoints(saved, line_numbers):
+    saved = sorted(saved, key=breakpoint_line)
+    line_numbers = sorted(line_numbers)
+    if len(saved) != len(line_numbers):
+        by_line = dict((breakpoint_line(bp), bp) for bp in saved)
+        saved = [by_line.get(n, n) for n in line_numbers]
+    return [make_breakpoint(n, bp if isinstance(bp, dict) else {}) for bp, n in zip(saved, line_numbers)]
+
+# milliseconds between the last breakpoint change and writing them all
+# to the settings
+BREAKPOINT_SAVE_DELAY = 1000
+
+class BreakpointStore(object):
+    """
+    Breakpoints as {filename : {line_number : options}}, read from the
+    settings once. Changes are written back together, once they stop
+    coming for BREAKPOINT_SAVE_DELAY
+    """
+    def __init__(self, settings_name):
+        self.settings_name = settings_name
+        self._files = None
+        self._changes = {}
+        self._save_scheduled = False
+
+    @property
+    def files(self):
+        if self._files is None:
+            saved = sublime.load_settings(self.settings_name).get('breakpoints', {})
+            self._files = {}
+            for filename, bps in saved.items():
+                self._files[filename] = dict((breakpoint_line(bp), self.options(bp)) for bp in bps)
+        return self._files
+
+    def options(self, bp):
+        return dict((k, v) for k, v in bp.items() if k != 'line_number') if isinstance(bp, dict) else {}
+
+    def get(self, filename, line_number):
+        return self.files.get(filename, {}).get(line_number)
+
+    def lines(self, filename):
+        return sorted(self.files.get(filename, {}))
+
+    def for_file(self, filename):
+        bps = self.files.get(filename, {})
+        return [make_breakpoint(n, bps[n]) for n in sorted(bps)]
+
+    # what the settings and the debugger get, {filename : [bp, ...]}
+    def as_dict(self):
+        return dict((f, self.for_file(f)) for f in self.files if self.files[f])
+
+    def set(self, filename, line_number, options):
+        self.files.setdefault(filename, {})[line_number] = options
+        self.schedule_save()
+
+    def remove(self, filename, line_number):
+        bps = self.files.get(filename)
+        if bps and bps.pop(line_number, None) is not None:
+            if not bps:
+                del self.files[filename]
+            self.schedule_save()
+
+    # the gutter regions follow edits, their lines replace the stored ones
+    # when the view has changed since it was last drawn or tracked. a view
+    # that was never drawn has no regions to go by
+    def track(self, view):
+        filename = view.file_name()
+        change = view.change_count()
+        last = self._changes.get(view.id())
+        if last is None or last == change:
+            return
+        self._changes[view.id()] = change
+        if not self.files.get(filename):
+            return
+        line_numbers = [util.line_number_for_region(view, r) for r in view.get_regions("debug_breakpoint")]
+        moved = moved_breakpoints(self.for_file(filename), line_numbers)
+        bps = dict((breakpoint_line(bp), self.options(bp)) for bp in moved)
+        if bps != self.files[filename]:
+            self.files[filename] = bps
+            self.schedule_save()
+
+    def drawn(self, view):
+        self._changes[view.id()] = view.change_count()
+
+    def schedule_save(self):
+        if self._save_scheduled:
+            return
+        self._save_scheduled = True
+        sublime.set_timeout(self.save, BREAKPOINT_SAVE_DELAY)
+
+    def save(self):
+        self._save_scheduled = False
+        sublime.load_settings(self.settings_name).set('breakpoints', self.as_dict())
+
+#-----------------------------------------------------------------------------
+# Protocol stats
+
+# the reply a command waits for. its round trip ends once the reply has
+# been handled. 'continue' has none, the next break is as far off as the
+# script makes it
+ROUND_TRIPS = {
+    'next' : 'break',
+    'stepin' : 'break',
+    'stepout' : 'break',
+    'getframes' : 'frames',
+    'variables' : 'variables',
+    'threads' : 'threads',
+}
+
+# latency samples kept per measurement, the percentiles are of these
+STATS_SAMPLES = 1000
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class ProtocolStats(object):
+    """
+    What a session's messages cost: count and bytes by direction and
+    command, and latency samples in seconds. A received message is timed
+    from the sender's timestamp to its handling (transit, which needs both
+    ends on one clock) and while it's handled. A round trip runs from a
+    command being sent to its reply having been handled, like next ->
+    break, and the part of it up to the reply's timestamp is the
+    debugger's. With a metrics_path every round trip is appended to that
+    file as a json line, and a summary once the session ends. output has
+    the debugger's own counts of output messages held back, sent when it
+    exits
+    """
+    def __init__(self, metrics_path=None, session_id=None):
+        self.metrics_path = metrics_path
+        self.session_id = session_id
+        self.messages = {}
+        self.latencies = {}
+        self.waiting = {}
+        self.output = {}
+
+    def count(self, direction, cmd, size):
+        counter = self.messages.get((direction, cmd))
+        if counter is None:
+            counter = self.messages[(direction, cmd)] = [0, 0]
+        counter[0] += 1
+        counter[1] += size
+
+    def sample(self, name, seconds):
+        samples = self.latencies.get(name)
+        if samples is None:
+            samples = self.latencies[name] = collections.deque(maxlen=STATS_SAMPLES)
+        samples.append(seconds)
+
+    def sent(self, cmd, size, sent_time):
+        self.count('>', cmd, size)
+        reply = ROUND_TRIPS.get(cmd)
+        if reply is not None:
+            self.waiting[reply] = (cmd, sent_time)
+
+    # start and end are when the message was handled. True if it ended a
+    # round trip
+    def received(self, cmd, size, sent_time, start, end):
+        self.count('<', cmd, size)
+        self.sample('handling ' + cmd, end - start)
+        if sent_time is not None:
+            self.sample('transit ' + cmd, start - sent_time)
+        request = self.waiting.pop(cmd, None)
+        if request is None:
+            return False
+        name = '{0} -> {1}'.format(request[0], cmd)
+        record = {'round_trip' : name, 'total' : end - request[1], 'handling' : end - start}
+        self.sample(name, record['total'])
+        if sent_time is not None:
+            record['debugger'] = sent_time - request[1]
+            record['transit'] = start - sent_time
+            self.sample(name + ' in debugger', record['debugger'])
+        self.write_metrics(record)
+        return True
+
+    def summary(self):
+        messages = {}
+        for (direction, cmd), (count, size) in self.messages.items():
+            messages['{0} {1}'.format(direction, cmd)] = {'count' : count, 'bytes' : size}
+        latencies = {}
+        for name, samples in self.latencies.items():
+            ordered = sorted(samples)
+            latencies[name] = {
+                'count' : len(ordered),
+                'p50' : percentile(ordered, 0.5),
+                'p90' : percentile(ordered, 0.9),
+                'p99' : percentile(ordered, 0.99),
+                'max' : ordered[-1],
+            }
+        return {'messages' : messages, 'latencies' : latencies, 'output' : self.output}
+
+    def report(self):
+        summary = self.summary()
+        lines = ['{0:<40}{1:>10}{2:>14}'.format('Messages', 'count', 'bytes')]
+        for name, counter in sorted(summary['messages'].items()):
+            lines.append('{0:<40}{1:>10}{2:>14}'.format(name, counter['count'], counter['bytes']))
+        lines.append('')
+        lines.append('{0:<40}{1:>10}{2:>10}{3:>10}{4:>10}{5:>10}'.format('Latency (ms)', 'count', 'p50', 'p90', 'p99', 'max'))
+        for name, latency in sorted(summary['latencies'].items()):
+            lines.append('{0:<40}{1:>10}{2:>10.2f}{3:>10.2f}{4:>10.2f}{5:>10.2f}'.format(name, latency['count'],
+                latency['p50'] * 1000, latency['p90'] * 1000, latency['p99'] * 1000, latency['max'] * 1000))
+        if summary['output']:
+            lines.append('')
+            lines.append('{0:<40}{1:>10}'.format('Output', 'count'))
+            lines.append('{0:<40}{1:>10}'.format('overtaken by a stop or reply', summary['output'].get('delayed', 0)))
+            lines.append('{0:<40}{1:>10}'.format('script waited on a full queue', summary['output'].get('throttled', 0)))
+        return '\n'.join(lines)
+
+    def write_metrics(self, record):
+        if not self.metrics_path:
+            return
+        record['time'] = time.time()
+        record['session'] = self.session_id
+        with open(self.metrics_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def close(self):
+        if self.messages:
+            self.write_metrics(self.summary())
+
 #-----------------------------------------------------------------------------
 # Debugger class - main interface to debugged process. Launches debugger.py
 # and communicates with it via json commands over stdio
 
 class Debugger(ProcessListener, JsonCmd):
-    def __init__(self, python_path='python', debugger_path=None):
+    """
+    One debug session, with its own process, panes and markers. Sessions
+    are created by DebugSessions, which holds what they share
+    """
+    def __init__(self, manager, session_id):
         JsonCmd.__init__(self)
 
-        if debugger_path is None:
-            debugger_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'debugger.py')
-        
-        self.layout = DebugLayout()
-        self.python_path = python_path
-        self.debugger_path = debugger_path
+        self.manager = manager
+        self.session_id = session_id
+        self.window_id = None
         self.proc = None
+        self._target = None
+        self.paused = False
+        self.checkpoint = None
+        self.parent = None
+        self.children = {}
+        self.threads_window = None
+        self.log = None
         self.output_pane = None
-        self.debugger_line = Marker('debug-current', scope='comment')
-        self.syntaxerror_line = Marker('debug-syntaxerror', scope='string', icon='bookmark')
+        self.stack_pane = None
+        self.variables_pane = None
+        self.profile_pane = None
+        self.stats_pane = None
+        self.stats = ProtocolStats()
+        self.seq = itertools.count(1)
+        self.debugger_line = Marker('debug-current-{0}'.format(session_id), scope='comment')
+        self.set_path_map({})
+        self.forget_stack()
+        self.forget_variables()
+        self.syntaxerror_line = Marker('debug-syntaxerror-{0}'.format(session_id), scope='string', icon='bookmark')
 
     @property
     def settings(self):
@@ -280,169 +1027,220 @@ class Debugger(ProcessListener, JsonCmd):
 
     @property
     def breakpoints(self):
-        return self.settings.get('breakpoints', {})
-
-    def breakpoints_for_file(self, filename):
-        views = list(util.views_for_file(filename))
-        if len(views) > 0:
-            view = views[0]
-            regions = view.get_regions("debug_breakpoint")
-            line_numbers = [util.line_number_for_region(view, r) for r in regions]
-            return line_numbers
-        else:
-            return self._load_for_file(filename)
-
-    def _load_for_file(self, filename):
-        return self.breakpoints.get(filename, [])
-
-    def _save_breakpoints(self, breakpoints):
-        for k in breakpoints.keys():
-            if len(breakpoints[k]) == 0:
-                del breakpoints[k]
-        self.settings.set('breakpoints', breakpoints)
+        return self.manager.breakpoints
 
-    def save_breakpoints(self, filename=None):
-        bps = self.breakpoints
-        for f in bps.keys():
-            if filename and filename != f: continue
-            bps.update({f:self.breakpoints_for_file(f)})
-        self._save_breakpoints(bps)
-
-    def add_breakpoint(self, filename, line_number):
-        bps = self.breakpoints_for_file(filename)
-        if line_number not in bps:
-            bps.append(line_number)
-        breakpoints = self.breakpoints
-        breakpoints.update({filename:bps})
-        self._save_breakpoints(breakpoints)
-
-        if self.running:
-            self.command('addbreakpoint', {
-                'filename' : filename,
-                'line_number' : line_number
-            })
-
-    def remove_breakpoint(self, filename, line_number):
-        bps = self.breakpoints_for_file(filename)
-        if line_number in bps:
-            bps.remove(line_number)
-        breakpoints = self.breakpoints
-        breakpoints.update({filename:bps})
-        self._save_breakpoints(breakpoints)
-
-        if self.running:
-            self.command('removebreakpoint', {
-                'filename' : filename,
-                'line_number' : line_number
-            })
-
-    def has_breakpoint(self, filename, line_number):
-        return line_number in self.breakpoints_for_file(filename)
+    # the first session's panes keep their plain names
+    def pane_name(self, name):
+        if self.session_id == 1:
+            return name
+        return "{0} #{1}".format(name, self.session_id)
 
-    def toggle_breakpoint(self, filename, line_number):
-        if self.has_breakpoint(filename, line_number):
-            self.remove_breakpoint(filename, line_number)
-        else:
-            self.add_breakpoint(filename, line_number)
-
-    def draw_breakpoints(self, view):
-        filename = view.file_name()
-        if filename is None:
-            return
-
-        line_numbers = self._load_for_file(filename)
-        regions = [util.region_for_line_number(view, n) for n in line_numbers]
-        view.add_regions(
-            "debug_breakpoint", 
-            regions, 
-            "string", 
-            "dot", 
-            sublime.PERSISTENT | sublime.HIDDEN
-        )
+    @property
+    def panes(self):
+        return [p for p in (self.output_pane, self.stack_pane, self.variables_pane, self.profile_pane) if p is not None]
 
-    def start(self, target):
+    # mode is 'debug', 'profile' to run the target untraced under a
+    # sampling profiler, 'heat' to count the lines it runs, or 'attach' to
+    # debug a running process through its agent, at the [host:]port target
+    def start(self, target, mode='debug'):
         self.syntaxerror_line.clear()
 
         self._target = target
+        self._mode = mode
         if isinstance(target, basestring):
             target = target.split()
 
         if self.running:
             self.stop()
 
-        self.save_breakpoints()
-
-        self.layout.apply()
-        self.output_pane = DebugWindow('Output', group=1)
-        self.stack_pane = DebugWindow('Call Stack', group=2)
-
-        self.outputline("Starting to debug {0}".format(target))
-
-        self.proc = InteractiveAsyncProcess([self.python_path, '-u', self.debugger_path] + target, {}, self)
+        self.manager.attach(self)
+        self.manager.save_breakpoints()
+        self.manager.close_profile()
+        self.stats = ProtocolStats(self.settings.get('metrics_file'), self.session_id)
+
+        self.manager.apply_layout(self)
+        self.open_log()
+        self.output_pane = DebugWindow(self.pane_name('Output'), group=1,
+            max_lines=self.settings.get('output_max_lines', 10000), log=self.log)
+        self.stack_pane = DebugWindow(self.pane_name('Call Stack'), group=2)
+        self.variables_pane = DebugWindow(self.pane_name('Variables'), group=3)
+        self.variables_pane.view.settings().set('debug_variables', True)
+        self.profile_pane = None
+        if mode == 'profile':
+            self.profile_pane = DebugWindow(self.pane_name('Profile'), group=2)
+
+        self.outputline("Starting to {0} {1}".format(mode, target))
+
+        # the framing is the debugger's, a remote one picks it with
+        # --compress, so it's told from what arrives first
+        remote = self.settings.get('remote')
+        if mode == 'attach':
+            host, _, port = target[0].rpartition(':')
+            remote = {'host' : host or '127.0.0.1', 'port' : int(port)}
+        self.framer = MessageFramer(binary=None)
+        self.set_path_map(remote.get('path_map', {}) if remote else {})
+        if remote:
+            self.outputline("[Connecting to {0}:{1}]".format(remote.get('host', '127.0.0.1'), remote['port']))
+            self.proc = RemoteProcess((remote.get('host', '127.0.0.1'), remote['port']), self,
+                loop=self.manager.loop)
+        else:
+            self.proc = self.manager.take_spare(self)
+        if self.proc is None:
+            self.proc = InteractiveAsyncProcess(self.manager.process_args(), self.manager.process_env(), self,
+                loop=self.manager.loop)
+        if mode == 'attach':
+            # the breakpoints go with every 'ready', see do_ready
+            return
+        if mode == 'heat':
+            self.manager.clear_heat()
+            self.command('heat', {
+                'target' : target,
+                'files' : self.manager.open_files(),
+                'interval' : self.settings.get('heat_interval'),
+            })
+            return
+        if mode == 'profile':
+            self.command('profile', {
+                'target' : target,
+                'rate' : self.settings.get('profile_rate'),
+            })
+            return
         self.command('start', {
             'target' : target,
-            'breakpoints' : self.breakpoints
+            'breakpoints' : self.breakpoints,
+            'checkpoint' : self.settings.get('restart_checkpoint'),
+            'children' : self.settings.get('debug_child_processes', True),
         })
 
+    # a child session shows up in its parent's panes, and goes through the
+    # parent's process
+    def attach_child(self, parent, child_id):
+        self.parent = parent
+        self._target = []
+        self._mode = 'debug'
+        self.log = parent.log
+        self.output_pane = parent.output_pane
+        self.stack_pane = parent.stack_pane
+        self.variables_pane = parent.variables_pane
+        self.to_local, self.to_remote = parent.to_local, parent.to_remote
+        self.stats = ProtocolStats(parent.stats.metrics_path, self.session_id)
+        self.proc = ChildProcess(parent, child_id)
+
     def stop(self):
         if not self.running:
             return
         self.proc.kill()
         self.finish()
 
+    # once the script passed its checkpoint, a restart while stopped has
+    # the debugger fork a fresh child from there instead of starting over
     def restart(self):
+        if self.parent is not None:
+            self.parent.restart()
+            return
+        if self.checkpoint is not None and self.paused:
+            self.resume('restart')
+            self.forget_stack()
+            self.forget_variables()
+            self.outputline("[Restarting from {0}:{1}]".format(self.checkpoint['filename'], self.checkpoint['line_number']))
+            return
         self.stop()
-        self.start(self._target)
+        self.start(self._target, self._mode)
 
-    def next(self):
+    def resume(self, cmd):
+        self.paused = False
         self.debugger_line.clear()
-        self.command('next')
+        self.command(cmd)
+
+    def next(self):
+        self.resume('next')
 
     def cont(self):
-        self.debugger_line.clear()
-        self.command('continue')
+        self.resume('continue')
 
     def stepout(self):
-        self.debugger_line.clear()
-        self.command('stepout')
+        self.resume('stepout')
 
     def stepin(self):
-        self.debugger_line.clear()
-        self.command('stepin')
+        self.resume('stepin')
 
     @property
     def running(self):
         return self.proc is not None
 
+    # path_map is {remote prefix : local prefix}, longest prefixes first
+    def set_path_map(self, path_map):
+        pairs = sorted(path_map.items(), key=lambda pair: -len(pair[0]))
+        self.to_local = pairs
+        self.to_remote = sorted([(local, remote) for remote, local in pairs], key=lambda pair: -len(pair[0]))
+
     def command(self, cmd, data=''):
+        if self.to_remote:
+            data = map_paths(data, self.to_remote)
         obj = {
             'command' : cmd,
-            'data' : data
+            'data' : data,
+            'seq' : next(self.seq),
+            'time' : time.time(),
         }
-        self.write_to_target(json.dumps(obj) + '\n')
+        line = json.dumps(obj) + '\n'
+        self.stats.sent(cmd, len(line), obj['time'])
+        self.write_to_target(line)
 
     def write_to_target(self, data):
         if not self.running:
             return
         self.proc.write_stdin(data)
 
+    # the output pane only keeps the last output_max_lines lines, everything
+    # is also written to a log file that can be opened on demand
+    @property
+    def log_path(self):
+        if self.parent is not None:
+            return self.parent.log_path
+        name = 'output.log' if self.session_id == 1 else 'output-{0}.log'.format(self.session_id)
+        return os.path.join(tempfile.gettempdir(), 'sublime-python-debugger', name)
+
+    def open_log(self):
+        self.close_log()
+        path = self.log_path
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.log = codecs.open(path, 'w', 'utf-8')
+
+    def close_log(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def show_log(self, window):
+        if self.output_pane is not None:
+            self.output_pane.flush()
+        if self.log is not None:
+            self.log.flush()
+        if os.path.exists(self.log_path):
+            window.open_file(self.log_path)
+
     def output(self, data):
         self.output_pane.append(data)
 
     def outputline(self, data):
         self.output_pane.appendline(data)
 
-    def process_line(self, line):
-        self.cmdloop(line.split('\n'))
+    # stderr isn't framed, it's whatever the debugger or script wrote there
+    def error_output(self, data):
+        self.output(data.decode('utf-8', 'replace'))
 
     def do_break(self, data):
+        self.paused = True
+        self.manager.focus(self)
         filename = data['filename']
         line_number = int(data['line_number'])
         break_type = data['type']
         msg = data['msg']
         
         self.debugger_line.mark(filename, line_number,
-            icon="circle" if self.has_breakpoint(filename, line_number) else "bookmark",
+            icon="circle" if self.manager.has_breakpoint(filename, line_number) else "bookmark",
             scope='comment' if break_type in ['exception', 'syntaxerror'] else "string"
         )
 
@@ -450,9 +1248,281 @@ class Debugger(ProcessListener, JsonCmd):
             sublime.status_message(msg)
             self.outputline('> {0}'.format(msg))
 
-        self.stack_pane.clear()
-        for frame in data['stack']:
-            self.stack_pane.appendline("<{0}:{1}> {2}".format(frame['filename'], frame['line_number'], frame['formatted']))
+        # any thread of the script can stop, the main one goes unmentioned
+        thread = data.get('thread')
+        if thread and thread['name'] != 'MainThread':
+            self.outputline('[Stopped in thread {0}]'.format(thread['name']))
+
+        self.forget_stack()
+        self.stop_id = data['stop_id']
+        self.stack_depth = data['depth']
+        self.stack_pages[self.stop_id] = {0 : data['stack']}
+        self.draw_stack()
+        self.forget_variables()
+        self.expand_variable(0)
+
+    # the debugger answers while stopped, with the threads in a quick panel
+    def show_threads(self, window):
+        self.threads_window = window
+        self.command('threads', {})
+
+    def do_threads(self, data):
+        window, self.threads_window = self.threads_window, None
+        threads = data['threads']
+        if window is None or not threads:
+            return
+        items = []
+        for t in threads:
+            where = 'no python frame'
+            if 'filename' in t:
+                where = '{0}:{1} {2}'.format(t['filename'], t['line_number'], t['function'])
+            items.append(['{0} ({1})'.format(t['name'], t['state']), where])
+        def on_done(index):
+            if index < 0 or 'filename' not in threads[index]:
+                return
+            view = util.show_file(threads[index]['filename'])
+            view.show(util.region_for_line_number(view, threads[index]['line_number']))
+        window.show_quick_panel(items, on_done)
+
+    def do_frames(self, data):
+        pages = self.stack_pages.get(data['stop_id'])
+        if pages is None:
+            return
+        self._frames_requested = False
+        if data['frames']:
+            pages[data['start']] = data['frames']
+            self.draw_stack()
+
+    # break events only carry the innermost frames. fetched pages are cached
+    # per stop, so a redraw never asks the debugger again
+    def forget_stack(self):
+        self.stop_id = None
+        self.stack_depth = 0
+        self.stack_pages = {}
+        self._frames_requested = False
+
+    def loaded_frames(self):
+        frames = []
+        pages = self.stack_pages.get(self.stop_id, {})
+        for start in sorted(pages.keys()):
+            frames.extend(pages[start])
+        return frames
+
+    @property
+    def has_more_frames(self):
+        return self.running and len(self.loaded_frames()) < self.stack_depth
+
+    def more_frames(self):
+        if not self.has_more_frames or self._frames_requested:
+            return
+        self._frames_requested = True
+        self.command('getframes', {
+            'stop_id' : self.stop_id,
+            'start' : len(self.loaded_frames()),
+        })
+
+    def draw_stack(self):
+        frames = self.loaded_frames()
+        lines = ["<{0}:{1}> {2}".format(f['filename'], f['line_number'], f['formatted']) for f in frames]
+        if len(frames) < self.stack_depth:
+            lines.append("... {0} more frames".format(self.stack_depth - len(frames)))
+        self.stack_pane.set_lines(lines)
+
+    # one row per line of the Variables pane. children are asked for when
+    # a row is expanded, a page at a time, and the replies are cached per
+    # stop since the handles in them are only good until the script moves on
+    def forget_variables(self):
+        self.variable_rows = [
+            {'name' : 'locals', 'ref' : 'locals', 'depth' : 0, 'expanded' : False},
+            {'name' : 'globals', 'ref' : 'globals', 'depth' : 0, 'expanded' : False},
+        ]
+        self.variable_pages = {}
+
+    def toggle_variable(self, index):
+        if index >= len(self.variable_rows):
+            return
+        if self.variable_rows[index]['expanded']:
+            self.collapse_variable(index)
+        else:
+            self.expand_variable(index)
+
+    def expand_variable(self, index):
+        row = self.variable_rows[index]
+        if not row['ref'] or row['expanded']:
+            return
+        row['expanded'] = True
+        start = row.get('start', 0)
+        page = self.variable_pages.get((self.stop_id, row['ref'], start))
+        if page is not None:
+            self.insert_variables(page)
+        elif self.running:
+            self.command('variables', {
+                'stop_id' : self.stop_id,
+                'ref' : row['ref'],
+                'start' : start,
+            })
+
+    def collapse_variable(self, index):
+        row = self.variable_rows[index]
+        row['expanded'] = False
+        end = index + 1
+        while end < len(self.variable_rows) and self.variable_rows[end]['depth'] > row['depth']:
+            end += 1
+        del self.variable_rows[index + 1:end]
+        self.draw_variables()
+
+    def do_variables(self, data):
+        if data['stop_id'] != self.stop_id:
+            return
+        self.variable_pages[(self.stop_id, data['ref'], data['start'])] = data
+        self.insert_variables(data)
+
+    def insert_variables(self, data):
+        for index, row in enumerate(self.variable_rows):
+            if row['ref'] == data['ref'] and row['expanded'] and row.get('start', 0) == data['start']:
+                break
+        else:
+            return
+        # a "more" row is replaced by the page it stood for
+        if row.get('more'):
+            depth = row['depth']
+            del self.variable_rows[index]
+        else:
+            depth = row['depth'] + 1
+            index += 1
+        rows = [{
+            'name' : child['name'],
+            'type' : child['type'],
+            'repr' : child['repr'],
+            'ref' : child['ref'],
+            'depth' : depth,
+            'expanded' : False,
+        } for child in data['children']]
+        if data['end'] < data['total']:
+            rows.append({
+                'more' : data['total'] - data['end'],
+                'ref' : data['ref'],
+                'start' : data['end'],
+                'depth' : depth,
+                'expanded' : False,
+            })
+        self.variable_rows[index:index] = rows
+        self.draw_variables()
+
+    def draw_variables(self):
+        lines = []
+        for row in self.variable_rows:
+            indent = '  ' * row['depth']
+            if row.get('more'):
+                lines.append("{0}  ... {1} more".format(indent, row['more']))
+                continue
+            marker = '- ' if row['expanded'] else '+ ' if row['ref'] else '  '
+            if 'repr' in row:
+                lines.append("{0}{1}{2} ({3}) = {4}".format(indent, marker, row['name'], row['type'], row['repr']))
+            else:
+                lines.append("{0}{1}{2}".format(indent, marker, row['name']))
+        self.variables_pane.set_text('\n'.join(lines))
+
+    # filenames from a remote debugger are mapped back to local ones
+    # a child session maps the paths in its own messages. every message is
+    # counted and timed while it's handled
+    def dispatch(self, cmd, data, line=None):
+        start = time.time()
+        if self.to_local and cmd not in ('output', 'child'):
+            data = map_paths(data, self.to_local, cmd == 'heat')
+        result = JsonCmd.dispatch(self, cmd, data, line)
+        size = len(line) if line is not None else len(data) if cmd == 'output' else 0
+        if self.stats.received(cmd, size, self.stamp[1], start, time.time()) and self.stats_pane is not None:
+            self.draw_stats()
+        return result
+
+    # kept up to date once shown, after every round trip
+    def show_stats(self):
+        if self.stats_pane is None:
+            self.stats_pane = DebugWindow(self.pane_name('Debugger Stats'), group=2)
+        self.draw_stats()
+
+    def draw_stats(self):
+        self.stats_pane.set_text(self.stats.report())
+
+    # what the debuggers of the script's child processes sent, in a
+    # session for each
+    def do_child(self, data):
+        child = self.children.get(data['id'])
+        if child is None:
+            child = self.children[data['id']] = self.manager.start_child(self, data['id'])
+        for cmd, child_data in data['messages']:
+            child.dispatch(cmd, child_data)
+        if data.get('closed'):
+            child.finish()
+
+    # a child's first message. a forked one already runs the script, a
+    # spawned one waits to be started like any session
+    def do_hello(self, data):
+        self._target = data['target']
+        self.outputline("[Child process {0} #{1}: {2}]".format(data['pid'], self.session_id, ' '.join(self._target)))
+        if not data['forked']:
+            self.command('start', {
+                'target' : self._target,
+                'breakpoints' : self.breakpoints,
+                'children' : self.settings.get('debug_child_processes', True),
+            })
+
+    # an agent detaches when the connection drops, so it is attached again
+    # on every new one
+    def do_ready(self, data):
+        if self._mode == 'attach':
+            self.command('attach', {'breakpoints' : self.breakpoints})
+
+    # the debugger is done, a remote one won't be reconnected
+    def do_exited(self, data):
+        if isinstance(self.proc, RemoteProcess):
+            self.proc.exited = True
+        if data:
+            self.stats.output = data
+            if self.stats_pane is not None:
+                self.draw_stats()
+
+    # called from the connecting thread, before anything is read
+    def on_connected(self, proc):
+        self.framer = MessageFramer(binary=None)
+
+    def do_checkpoint(self, data):
+        self.checkpoint = data
+
+    # the new child has the breakpoints of when the checkpoint was taken
+    def do_restarted(self, data):
+        self.command('resume', {'breakpoints' : self.breakpoints})
+
+    # logpoint messages arrive in batches, rate limited by the debugger
+    def do_logpoint(self, data):
+        lines = [m['text'] for m in data['messages']]
+        if data['dropped']:
+            lines.append('[{0} logpoint messages dropped]'.format(data['dropped']))
+        self.output(''.join(line + '\n' for line in lines))
+
+    # the debugger sends the whole table every report, it replaces the last
+    def do_profile(self, data):
+        samples = data['samples'] or 1
+        lines = ["{0} samples{1}".format(data['samples'], '' if data['done'] else ' (running)'), ""]
+        lines.append("   self   total  function")
+        for f in data['functions']:
+            lines.append("{0:6.1f}% {1:6.1f}%  {2} <{3}:{4}>".format(100.0 * f['self'] / samples,
+                100.0 * f['total'] / samples, f['name'], f['filename'], f['line_number']))
+        lines += ["", "  lines  line"]
+        for l in data['lines']:
+            lines.append("{0:6.1f}%  <{1}:{2}>".format(100.0 * l['count'] / samples, l['filename'], l['line_number']))
+        lines += ["", " stacks  stack"]
+        for st in data['stacks']:
+            lines.append("{0:6.1f}%  {1}".format(100.0 * st['count'] / samples, st['stack']))
+        self.profile_pane.set_text('\n'.join(lines))
+
+    # deltas since the last message, for the files that changed
+    def do_heat(self, data):
+        self.manager.add_heat(data)
+
+    def do_breakpointerror(self, data):
+        self.outputline('*** {0}:{1}: {2}'.format(data['filename'], data['line_number'], data['msg']))
 
     def do_exception(self, data):
         self.outputline('*** Exception: {0}'.format(data))
@@ -463,29 +1533,372 @@ class Debugger(ProcessListener, JsonCmd):
     def finish(self):
         if self.proc is None:
             return
-        
-        self.outputline("[Debug session ended]")
-        sublime.status_message("Debug session ended")
+        for child in list(self.children.values()):
+            child.finish()
+
+        if self.parent is not None:
+            self.outputline("[Child process #{0} ended]".format(self.session_id))
+        else:
+            self.outputline("[Debug session ended]")
+            sublime.status_message("Debug session ended")
 
         self.debugger_line.clear()
+        self.forget_stack()
+        self.forget_variables()
+        self.paused = False
+        self.checkpoint = None
+        self.stats.close()
+        if self.stats_pane is not None:
+            self.stats_pane.close()
+            self.stats_pane = None
+
+        # the panes are the parent's
+        if self.parent is not None:
+            self.parent.children.pop(self.proc.child_id, None)
+            self.proc = None
+            self.manager.detach(self)
+            return
         self.proc = None
-        
+
         self.output_pane.close()
         self.stack_pane.close()
-        self.layout.revert()
-
-    # called from debugger thread
+        self.variables_pane.close()
+        if self.profile_pane is not None:
+            self.manager.keep_profile(self.profile_pane)
+            self.profile_pane = None
+        self.close_log()
+        self.manager.revert_layout(self)
+        self.manager.detach(self)
+        self.manager.spawn_spare()
+
+    def queue_data(self, handler, data=None):
+        self.manager.queue_data(self, handler, data)
+
+    # called from the io thread. the framer keeps a message that straddles
+    # two reads until the rest of it arrives, the ui thread only gets
+    # complete ones
     def on_data(self, proc, data):
-        sublime.set_timeout(functools.partial(self.process_line, data), 0)
+        frames = self.framer.feed(data)
+        if frames:
+            self.queue_data(self.dispatch_frames, frames)
 
-    # called from debugger thread
+    # called from the io thread
+    def on_error_data(self, proc, data):
+        self.queue_data(self.error_output, data)
+
+    # called from the io thread
     def on_finished(self, proc):
-        sublime.set_timeout(self.finish, 0)
+        self.queue_data(self.finish)
+
+class DebugSessions(object):
+    """
+    The debug sessions, one per target. Breakpoints, heat counts, the
+    spare process and the I/O loop are shared by all of them. The Profile
+    pane of the last profiled run stays open until the next start. Session
+    commands go to the focused session: the one that last stopped, was
+    started, or had one of its panes activated
+    """
+    def __init__(self, python_path='python', debugger_path=None):
+        if debugger_path is None:
+            debugger_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'debugger.py')
+        self.python_path = python_path
+        self.debugger_path = debugger_path
+        self.sessions = []
+        self.focused = None
+        self.layouts = {}
+        self.spare = None
+        self.profile_pane = None
+        self.loop = IOLoop()
+        self.heat = {}
+        self.breakpoint_store = BreakpointStore('python-debugger')
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._pending_scheduled = False
+
+    @property
+    def settings(self):
+        return sublime.load_settings('python-debugger')
+
+    @property
+    def running(self):
+        return self.focused is not None and self.focused.running
+
+    def process_args(self):
+        return [self.python_path, '-u', self.debugger_path]
+
+    def process_env(self):
+        # tracing engine is picked by interpreter version unless overridden
+        env = {}
+        engine = self.settings.get('engine')
+        if engine:
+            env['PYTHON_DEBUGGER_ENGINE'] = engine
+
+        # 'binary' has the debugger length-prefix its messages
+        env['PYTHON_DEBUGGER_FRAMING'] = self.settings.get('framing', 'lines')
+
+        # imported by a spare process while it waits for a session
+        preload = self.settings.get('preload_modules', [])
+        if preload:
+            env['PYTHON_DEBUGGER_PRELOAD'] = ','.join(preload)
+        return env
+
+    def session_for(self, target):
+        if isinstance(target, basestring):
+            target = target.split()
+        for session in self.sessions:
+            if session._target == target and session.parent is None:
+                return session
+        return None
+
+    # child sessions share their parent's panes, which belong to whichever
+    # of them is focused
+    def session_for_view(self, view):
+        sessions = self.sessions
+        if self.focused in sessions:
+            sessions = [self.focused] + sessions
+        for session in sessions:
+            if view.id() in [p.view.id() for p in session.panes if p.view is not None]:
+                return session
+            if session.debugger_line.view is not None and session.debugger_line.view.id() == view.id():
+                return session
+        return None
+
+    # a target that already has a session is restarted in it
+    def start(self, target, mode='debug'):
+        if isinstance(target, basestring):
+            target = target.split()
+        session = self.session_for(target)
+        if session is None:
+            session = Debugger(self, self.new_session_id())
+        session.start(target, mode)
+
+    # a python process started by a session's script gets a session of its
+    # own, which is focused once it stops
+    def start_child(self, parent, child_id):
+        session = Debugger(self, self.new_session_id())
+        session.attach_child(parent, child_id)
+        self.sessions.append(session)
+        return session
+
+    def new_session_id(self):
+        ids = set(s.session_id for s in self.sessions)
+        session_id = 1
+        while session_id in ids:
+            session_id += 1
+        return session_id
+
+    # data from the io thread is queued with the session and method that
+    # handle it. every session's data goes to the ui thread together, in at
+    # most one callback per OUTPUT_INTERVAL
+    def queue_data(self, session, handler, data=None):
+        with self._pending_lock:
+            self._pending.append((session, handler, data))
+            if self._pending_scheduled:
+                return
+            self._pending_scheduled = True
+        sublime.set_timeout(self.process_pending, OUTPUT_INTERVAL)
+
+    def process_pending(self):
+        with self._pending_lock:
+            pending = self._pending
+            self._pending = []
+            self._pending_scheduled = False
+        for session, handler, data in pending:
+            if not session.running:
+                continue
+            if data is None:
+                handler()
+            else:
+                handler(data)
+
+    def attach(self, session):
+        if session not in self.sessions:
+            self.sessions.append(session)
+        self.focus(session)
+
+    # a finished session stays focused while there is no other, so its
+    # log can still be shown
+    def detach(self, session):
+        if session in self.sessions:
+            self.sessions.remove(session)
+        if self.focused is session and self.sessions:
+            self.focused = self.sessions[-1]
+
+    def focus(self, session):
+        self.focused = session
+
+    # sessions in one window share its debug layout, the first applies it
+    # and the last to finish reverts it
+    def apply_layout(self, session):
+        window = sublime.active_window()
+        session.window_id = window.id()
+        if window.id() not in self.layouts:
+            layout = self.layouts[window.id()] = DebugLayout()
+            layout.apply(window)
+
+    def revert_layout(self, session):
+        window_id, session.window_id = session.window_id, None
+        if any(s.window_id == window_id for s in self.sessions if s is not session):
+            return
+        layout = self.layouts.pop(window_id, None)
+        if layout is not None:
+            layout.revert()
+
+    # a finished run's profile is kept for reading, the next start closes it
+    def keep_profile(self, pane):
+        self.close_profile()
+        self.profile_pane = pane
+
+    def close_profile(self):
+        if self.profile_pane is not None:
+            self.profile_pane.close()
+            self.profile_pane = None
+
+    # the next session's debugger.py is started when the plugin loads and
+    # again whenever one is taken or ends, so start() only has to send it
+    # the 'start' command
+    def spawn_spare(self):
+        if self.spare is not None or not self.settings.get('warm_start', True) or self.settings.get('remote'):
+            return
+        self.spare = SpareProcess(self.process_args(), self.process_env(), loop=self.loop)
+
+    # the next one is spawned right away, for a restart
+    def take_spare(self, session):
+        spare, self.spare = self.spare, None
+        proc = None
+        if spare is not None:
+            if spare.finished or spare.key != (tuple(self.process_args()), tuple(sorted(self.process_env().items()))):
+                spare.kill()
+            else:
+                proc, saved = spare.take(session)
+                session.outputline("[Warm start saved {0:.2f}s]".format(saved))
+        self.spawn_spare()
+        return proc
+
+    def set_checkpoint(self, checkpoint):
+        self.settings.set('restart_checkpoint', checkpoint)
+
+    # breakpoints are the same for every session, changes are sent to all
+    # the running ones
+    @property
+    def breakpoints(self):
+        return self.breakpoint_store.as_dict()
+
+    # picks up lines moved by edits in a view of the file
+    def track_breakpoints(self, filename):
+        for view in util.views_for_file(filename):
+            self.breakpoint_store.track(view)
+            return
+
+    def breakpoints_for_file(self, filename):
+        self.track_breakpoints(filename)
+        return self.breakpoint_store.for_file(filename)
+
+    def breakpoint_options(self, filename, line_number):
+        self.track_breakpoints(filename)
+        return self.breakpoint_store.get(filename, line_number)
+
+    # without a filename every open view with breakpoints is tracked
+    def save_breakpoints(self, filename=None):
+        if filename:
+            self.track_breakpoints(filename)
+            return
+        for window in sublime.windows():
+            for view in window.views():
+                if view.file_name() in self.breakpoint_store.files:
+                    self.breakpoint_store.track(view)
+
+    # adding a breakpoint that's already there replaces its options
+    def add_breakpoint(self, filename, line_number, **options):
+        self.track_breakpoints(filename)
+        bp = make_breakpoint(line_number, options)
+        self.breakpoint_store.set(filename, line_number, self.breakpoint_store.options(bp))
+
+        data = dict(bp) if isinstance(bp, dict) else {'line_number' : line_number}
+        data['filename'] = filename
+        for session in self.sessions:
+            if session.running:
+                session.command('addbreakpoint', data)
+
+    def remove_breakpoint(self, filename, line_number):
+        self.track_breakpoints(filename)
+        self.breakpoint_store.remove(filename, line_number)
+
+        for session in self.sessions:
+            if session.running:
+                session.command('removebreakpoint', {
+                    'filename' : filename,
+                    'line_number' : line_number
+                })
+
+    def has_breakpoint(self, filename, line_number):
+        return self.breakpoint_options(filename, line_number) is not None
+
+    def toggle_breakpoint(self, filename, line_number):
+        if self.has_breakpoint(filename, line_number):
+            self.remove_breakpoint(filename, line_number)
+        else:
+            self.add_breakpoint(filename, line_number)
+
+    def draw_breakpoints(self, view):
+        filename = view.file_name()
+        if filename is None:
+            return
+
+        self.breakpoint_store.track(view)
+        line_numbers = self.breakpoint_store.lines(filename)
+        regions = [util.region_for_line_number(view, n) for n in line_numbers]
+        view.add_regions(
+            "debug_breakpoint", 
+            regions, 
+            "string", 
+            "dot", 
+            sublime.PERSISTENT | sublime.HIDDEN
+        )
+        self.breakpoint_store.drawn(view)
+
+    # line counts from the last heat session, {filename : {line : count}}
+    def add_heat(self, data):
+        for filename, delta in data.items():
+            counts = self.heat.setdefault(filename, {})
+            for line_number, count in delta:
+                counts[line_number] = counts.get(line_number, 0) + count
+            for view in util.views_for_file(filename):
+                self.draw_heat(view)
+
+    def draw_heat(self, view):
+        filename = view.file_name()
+        counts = self.heat.get(filename) if filename else None
+        grades = [[] for scope in HEAT_SCOPES]
+        if counts:
+            top = max(counts.values())
+            for line_number, count in counts.items():
+                grades[heat_grade(count, top)].append(util.region_for_line_number(view, line_number))
+        for grade, scope in enumerate(HEAT_SCOPES):
+            view.add_regions("debug_heat_{0}".format(grade), grades[grade], scope, "dot", sublime.HIDDEN)
+
+    def clear_heat(self):
+        self.heat = {}
+        for window in sublime.windows():
+            for view in window.views():
+                for grade in range(len(HEAT_SCOPES)):
+                    view.erase_regions("debug_heat_{0}".format(grade))
+
+    # only files open in a view are counted, the debugger never sends
+    # the rest
+    def open_files(self):
+        files = set()
+        for window in sublime.windows():
+            for view in window.views():
+                if view.file_name():
+                    files.add(view.file_name())
+        return list(files)
 
 # we should pass in a custom python path to use virtualenv
 # maybe read from build settings using SublimeREPL build system hack?
-# debugger = Debugger(python_path='path/to/venv')
-debugger = Debugger()
+# sessions = DebugSessions(python_path='path/to/venv')
+sessions = DebugSessions()
+sublime.set_timeout(sessions.spawn_spare, 0)
 
 
 #-----------------------------------------------------------------------------
@@ -494,52 +1907,99 @@ debugger = Debugger()
 # window commands
 
 class DebugStartCommand(sublime_plugin.WindowCommand):
-    def run(self, target=''):
-        debugger.start(target)
+    def run(self, target='', mode='debug'):
+        sessions.start(target, mode)
+
+class DebugAttachCommand(sublime_plugin.WindowCommand):
+    def run(self, address=None):
+        if address is None:
+            address = sublime.load_settings('python-debugger').get('attach_address', '127.0.0.1:5679')
+        sessions.start([str(address)], 'attach')
 
 class DebugStopCommand(sublime_plugin.WindowCommand):
     def run(self):
-        debugger.stop()
+        sessions.focused.stop()
 
     def is_enabled(self):
-        return debugger.running
+        return sessions.running
 
 class DebugRestartCommand(sublime_plugin.WindowCommand):
     def run(self):
-        debugger.restart()
+        sessions.focused.restart()
 
     def is_enabled(self):
-        return debugger.running
+        return sessions.running
 
 class DebugStepCommand(sublime_plugin.WindowCommand):
     def run(self):
-        debugger.stepin()
+        sessions.focused.stepin()
 
     def is_enabled(self):
-        return debugger.running
+        return sessions.running
 
 class DebugStepOutCommand(sublime_plugin.WindowCommand):
     def run(self):
-        debugger.stepout()
+        sessions.focused.stepout()
 
     def is_enabled(self):
-        return debugger.running
+        return sessions.running
 
 
 class DebugNextCommand(sublime_plugin.WindowCommand):
     def run(self):
-        debugger.next()
+        sessions.focused.next()
 
     def is_enabled(self):
-        return debugger.running
+        return sessions.running
 
 
 class DebugContinueCommand(sublime_plugin.WindowCommand):
     def run(self):
-        debugger.cont()
+        sessions.focused.cont()
+
+    def is_enabled(self):
+        return sessions.running
+
+class DebugMoreFramesCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        sessions.focused.more_frames()
 
     def is_enabled(self):
-        return debugger.running
+        return sessions.running and sessions.focused.has_more_frames
+
+class DebugFocusSessionCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        self.choices = list(sessions.sessions)
+        self.window.show_quick_panel(
+            ["#{0} {1}".format(s.session_id, ' '.join(s._target)) for s in self.choices], self.on_done)
+
+    def on_done(self, index):
+        if index >= 0:
+            sessions.focus(self.choices[index])
+
+    def is_enabled(self):
+        return len(sessions.sessions) > 1
+
+class DebugShowThreadsCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        sessions.focused.show_threads(self.window)
+
+    def is_enabled(self):
+        return sessions.running and sessions.focused.paused
+
+class DebugShowStatsCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        sessions.focused.show_stats()
+
+    def is_enabled(self):
+        return sessions.running
+
+class DebugShowLogCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        sessions.focused.show_log(self.window)
+
+    def is_enabled(self):
+        return sessions.focused is not None and os.path.exists(sessions.focused.log_path)
 
 # text (view) commands
 
@@ -551,12 +2011,62 @@ class DebugCurrentFileCommand(sublime_plugin.TextCommand):
         self.view.window().run_command('debug_start', {'target' : [self.view.file_name()]})
 
     def is_visible(self):
-        return not debugger.running
+        return sessions.session_for([self.view.file_name()]) is None
 
     def is_enabled(self):
         return util.file_type(self.view) in ["python"]
 
 
+class DebugSetCheckpointCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        filename = self.view.file_name()
+        if filename is None:
+            return
+        sessions.set_checkpoint({
+            'filename' : filename,
+            'line_number' : util.line_number_for_region(self.view, self.view.sel()[0]),
+        })
+
+    def is_enabled(self):
+        return util.file_type(self.view) in ["python"]
+
+
+class DebugProfileCurrentFileCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        if not self.view.file_name():
+            return
+        self.view.run_command('save')
+        self.view.window().run_command('debug_start', {'target' : [self.view.file_name()], 'mode' : 'profile'})
+
+    def is_visible(self):
+        return sessions.session_for([self.view.file_name()]) is None
+
+    def is_enabled(self):
+        return util.file_type(self.view) in ["python"]
+
+
+class DebugHeatCurrentFileCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        if not self.view.file_name():
+            return
+        self.view.run_command('save')
+        self.view.window().run_command('debug_start', {'target' : [self.view.file_name()], 'mode' : 'heat'})
+
+    def is_visible(self):
+        return sessions.session_for([self.view.file_name()]) is None
+
+    def is_enabled(self):
+        return util.file_type(self.view) in ["python"]
+
+
+class DebugClearHeatCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        sessions.clear_heat()
+
+    def is_enabled(self):
+        return bool(sessions.heat)
+
+
 class DebugToggleBreakpointCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         # no breakpoints if file isn't saved on disk
@@ -566,44 +2076,173 @@ class DebugToggleBreakpointCommand(sublime_plugin.TextCommand):
 
         line_numbers = [util.line_number_for_region(self.view, r) for r in self.view.sel()]
         for line_number in line_numbers:
-            debugger.toggle_breakpoint(filename, line_number)
+            sessions.toggle_breakpoint(filename, line_number)
 
         for view in util.views_for_file(filename):
-            debugger.draw_breakpoints(view)
+            sessions.draw_breakpoints(view)
 
 
-class DebugOutputCommand(sublime_plugin.TextCommand):
+class DebugExpandVariableCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        session = sessions.session_for_view(self.view)
+        if session is not None:
+            session.toggle_variable(self.view.rowcol(self.view.sel()[0].begin())[0])
+
+    def is_enabled(self):
+        return sessions.session_for_view(self.view) is not None
+
+
+class DebugReplaceCommand(sublime_plugin.TextCommand):
     def run(self, edit, data):
+        row = self.view.rowcol(self.view.sel()[0].begin())[0]
+        self.view.set_read_only(False)
+        self.view.replace(edit, sublime.Region(0, self.view.size()), data)
+        self.view.set_read_only(True)
+        self.view.sel().clear()
+        self.view.sel().add(sublime.Region(self.view.text_point(row, 0)))
+
+
+class DebugReplaceLinesCommand(sublime_plugin.TextCommand):
+    """
+    Replaces lines start to end (the rest of the view when None) in one
+    edit, the selection and scroll position stay where they were
+    """
+    def run(self, edit, start, end, lines):
+        rows = [self.view.rowcol(r.begin())[0] for r in self.view.sel()]
+        viewport = self.view.viewport_position()
+        end_point = self.view.size() if end is None else self.view.text_point(end, 0)
+        self.view.set_read_only(False)
+        self.view.replace(edit, sublime.Region(self.view.text_point(start, 0), end_point),
+            ''.join(line + '\n' for line in lines))
+        self.view.set_read_only(True)
+        self.view.sel().clear()
+        for row in rows:
+            self.view.sel().add(sublime.Region(self.view.text_point(row, 0)))
+        self.view.set_viewport_position(viewport, False)
+
+
+class DebugEditBreakpointCommand(sublime_plugin.TextCommand):
+    """
+    Asks for a condition, then for 'hit count, ignore count'. A line
+    without a breakpoint gets one
+    """
+    def run(self, edit):
+        self.filename = self.view.file_name()
+        if self.filename is None:
+            return
+        self.line_number = util.line_number_for_region(self.view, self.view.sel()[0])
+        self.options = sessions.breakpoint_options(self.filename, self.line_number) or {}
+        self.view.window().show_input_panel('Breakpoint condition:',
+            self.options.get('condition', ''), self.on_condition, None, None)
+
+    def on_condition(self, condition):
+        self.options['condition'] = condition.strip()
+        counts = '{0}, {1}'.format(self.options.get('hit_count', 0), self.options.get('ignore_count', 0))
+        self.view.window().show_input_panel('Stop every Nth hit, ignoring the first M (N, M):',
+            counts, self.on_counts, None, None)
+
+    def on_counts(self, counts):
+        try:
+            numbers = [int(n) for n in counts.replace(',', ' ').split()]
+        except ValueError:
+            sublime.status_message('Hit counts must be numbers')
+            return
+        numbers += [0, 0]
+        self.options['hit_count'], self.options['ignore_count'] = numbers[:2]
+        sessions.add_breakpoint(self.filename, self.line_number, **self.options)
+        for view in util.views_for_file(self.filename):
+            sessions.draw_breakpoints(view)
+
+    def is_enabled(self):
+        return util.file_type(self.view) in ["python"]
+
+
+class DebugEditLogpointCommand(sublime_plugin.TextCommand):
+    """
+    Turns the line's breakpoint into a logpoint, {expressions} in the
+    message are evaluated in the frame. An empty message makes it a
+    breakpoint again
+    """
+    def run(self, edit):
+        self.filename = self.view.file_name()
+        if self.filename is None:
+            return
+        self.line_number = util.line_number_for_region(self.view, self.view.sel()[0])
+        self.options = sessions.breakpoint_options(self.filename, self.line_number) or {}
+        self.view.window().show_input_panel('Log message:',
+            self.options.get('log', ''), self.on_done, None, None)
+
+    def on_done(self, log):
+        self.options['log'] = log
+        sessions.add_breakpoint(self.filename, self.line_number, **self.options)
+        for view in util.views_for_file(self.filename):
+            sessions.draw_breakpoints(view)
+
+    def is_enabled(self):
+        return util.file_type(self.view) in ["python"]
+
+
+class DebugOutputCommand(sublime_plugin.TextCommand):
+    def run(self, edit, data, max_lines=None):
         at_end = self.view.sel()[0].begin() == self.view.size()
         self.view.set_read_only(False)
         self.view.insert(edit, self.view.size(), data)
+        if max_lines:
+            self.trim(edit, max_lines)
         if at_end:
             self.view.show(self.view.size())
         self.view.set_read_only(True)
 
+    # drop the oldest lines, letting the view grow a tenth past max_lines
+    # first so the erase isn't paid on every append
+    def trim(self, edit, max_lines):
+        lines = self.view.rowcol(self.view.size())[0] + 1
+        if lines <= max_lines + max_lines // 10:
+            return
+        end = self.view.text_point(lines - max_lines, 0)
+        self.view.erase(edit, sublime.Region(0, end))
+
 
 class DebuggerListener(sublime_plugin.EventListener):
     def on_load(self, view):
-        debugger.draw_breakpoints(view)
+        util.index_view(view)
+        sessions.draw_breakpoints(view)
+        sessions.draw_heat(view)
 
     def on_new(self, view):
-        debugger.draw_breakpoints(view)
+        sessions.draw_breakpoints(view)
 
     def on_clone(self, view):
-        debugger.draw_breakpoints(view)
+        util.index_view(view)
+        sessions.draw_breakpoints(view)
+        sessions.draw_heat(view)
 
     def on_pre_save(self, view):
-        debugger.save_breakpoints(view.file_name())
+        sessions.save_breakpoints(view.file_name())
+
+    # save as moves the view to its new path
+    def on_post_save(self, view):
+        util.index_view(view)
+
+    def on_close(self, view):
+        util.forget_view(view)
 
     def on_query_context(self, view, key, operator, operand, match_all):
         if key == "debugger_running":
-            return debugger.running
+            return sessions.running
         return None
 
+    # activating a session's pane or stopped file focuses that session
+    def on_activated(self, view):
+        session = sessions.session_for_view(view)
+        if session is not None:
+            sessions.focus(session)
+
     def on_selection_modified(self, view):
-        syntax_err_view = debugger.syntaxerror_line.view
-        if syntax_err_view and syntax_err_view.id() == view.id():
-            for r in view.sel():
-                if r.intersects(debugger.syntaxerror_line.region):
-                    debugger.syntaxerror_line.clear()
-                    break
\ No newline at end of file
+        for session in sessions.sessions:
+            syntax_err_view = session.syntaxerror_line.view
+            if syntax_err_view and syntax_err_view.id() == view.id():
+                for r in view.sel():
+                    if r.intersects(session.syntaxerror_line.region):
+                        session.syntaxerror_line.clear()
+                        break
\ No newline at end of file
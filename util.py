@@ -11,27 +11,64 @@ def line_number_for_region(view, region):
 def file_type(view):
     return view.scope_name(0).split(" ")[0].split(".")[1]
 
+# realpath hits the disk for every path component, each file name is
+# only resolved once
+_realpaths = {}
+
+def realpath(filename):
+    path = _realpaths.get(filename)
+    if path is None:
+        path = _realpaths[filename] = os.path.realpath(filename)
+    return path
+
+# views by the real path of their file, and the path of each view by its
+# id. built from every open view on first use, then kept up to date by
+# index_view and forget_view
+_views = None
+_view_paths = {}
+
+def _index():
+    global _views
+    if _views is None:
+        _views = {}
+        for w in sublime.windows():
+            for v in w.views():
+                index_view(v)
+    return _views
+
+# building the index lists the view already, so it's built before the view
+# is forgotten and added back once
+def index_view(view):
+    views = _index()
+    forget_view(view)
+    if not view.file_name(): return
+    path = realpath(view.file_name())
+    _view_paths[view.id()] = path
+    views.setdefault(path, []).append(view)
+
+def forget_view(view):
+    path = _view_paths.pop(view.id(), None)
+    if path is None or _views is None: return
+    views = [v for v in _views.get(path, []) if v.id() != view.id()]
+    if views:
+        _views[path] = views
+    else:
+        _views.pop(path, None)
+
 def show_file(filename):
     window = sublime.active_window()
-    views = window.views()
-    for v in views:
-        if not v.file_name(): continue
-        path = os.path.realpath(v.file_name())
-        if path == os.path.realpath(filename):
+    for v in views_for_file(filename):
+        if v.window() and v.window().id() == window.id():
             window.focus_view(v)
             return v
     # not found? open
     window.focus_group(0)
     v = window.open_file(filename)
+    index_view(v)
     return v
 
 def views_for_file(filename):
-    path = os.path.realpath(filename)
-    for w in sublime.windows():
-        for v in w.views():
-            if not v.file_name(): continue
-            if path == os.path.realpath(v.file_name()):
-                yield v
+    return list(_index().get(realpath(filename), []))
 
 
 def move_to_group(window, view, group):